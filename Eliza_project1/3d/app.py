@@ -5,13 +5,28 @@ import os
 import nibabel as nib
 import numpy as np
 import tempfile
+import hashlib
+import shutil
+import sqlite3
+import time
+import json
+import uuid
+import contextvars
+import tracemalloc
+import weakref
+import threading
 from skimage import measure
 import plotly.graph_objects as go
 from scipy import ndimage
 import google.generativeai as genai
 import traceback
-from typing import Optional, Tuple
-from concurrent.futures import ThreadPoolExecutor
+from typing import List, Optional, Tuple
+from collections import OrderedDict
+from contextlib import contextmanager
+from dataclasses import asdict, dataclass
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+import multiprocessing
+from multiprocessing import shared_memory
 import warnings
 warnings.filterwarnings('ignore')
 
@@ -33,41 +48,321 @@ class BrainAnalysisError(Exception):
     pass
 
 def process_slice(args):
-    """Process a single slice for parallel processing"""
+    """Apply CLAHE to a single 2D slice, returning uint8.
+    
+    Non-uint8 slices are min-max stretched straight into a uint8 buffer by OpenCV,
+    without float64 temporaries.
+    """
     slice_2d, clahe = args
+    if slice_2d.dtype != np.uint8:
+        slice_2d = cv2.normalize(slice_2d, None, 0, 255, cv2.NORM_MINMAX, dtype=cv2.CV_8U)
+    return clahe.apply(slice_2d)
+
+# Loader dtype policies for safe_load_volume:
+#   "float64" - scaled float64 volume (legacy behaviour)
+#   "float32" - scaled float32 volume, half the memory of float64
+#   "native"  - on-disk dtype kept as-is (memory-mapped for uncompressed .nii);
+#               scans that carry a scl_slope/scl_inter fall back to float32
+VOLUME_DTYPE_POLICIES = ("float64", "float32", "native")
+# Number of z-slices converted at once when scaling or normalizing a volume
+SLAB_DEPTH = 16
+# Threads used to decode slice images from .zip stacks
+ZIP_DECODE_WORKERS = min(8, os.cpu_count() or 1)
+# Optional CLAHE preprocessing: OpenCV releases the GIL, so slices are enhanced in a thread pool
+CLAHE_WORKERS = min(8, os.cpu_count() or 1)
+CLAHE_CLIP_LIMIT = 2.0
+CLAHE_TILE_GRID = (8, 8)
+# On-disk cache of normalized volumes, shared by every session on this host
+VOLUME_CACHE_DIR = os.environ.get("MRIXAI_VOLUME_CACHE_DIR", os.path.join(tempfile.gettempdir(), "mrixai_volume_cache"))
+VOLUME_CACHE_MAX_BYTES = int(float(os.environ.get("MRIXAI_VOLUME_CACHE_MB", "2048")) * 1024 * 1024)
+# Out-of-core segmentation: slab halos (in voxels) covering the reach of each stage
+GAUSSIAN_HALO = 4       # sigma=1.0 with scipy's default truncate=4.0
+MORPHOLOGY_HALO = 4     # opening + closing with a 3x3x3 box, four passes of radius 1
+CLEANUP_HALO = 2        # final dilation + erosion
+# Rough working set of the in-memory segmentation path (float64 copies plus labels)
+SEGMENT_BYTES_PER_VOXEL = 40
+SEGMENT_MEMORY_BUDGET_BYTES = int(float(os.environ.get("MRIXAI_SEGMENT_MEMORY_MB", "2048")) * 1024 * 1024)
+# Scratch space for out-of-core intermediates (system temp directory when unset)
+SEGMENT_WORK_DIR = os.environ.get("MRIXAI_SEGMENT_WORK_DIR")
+# Streaming percentile histograms: bins per pass and largest bin gathered in memory (at most one slab's worth)
+STREAM_HISTOGRAM_BINS = 65536
+STREAM_MAX_CANDIDATES = 1 << 22
+# Planes per block when accumulating region properties
+REGION_BLOCK_PLANES = 32
+# Parameter sets kept per segmentation stage in a SegmentationStages cache, and the byte budget
+# of all its stages together (the enhanced volume alone is 8 bytes per voxel)
+SEGMENT_STAGE_ENTRIES = 2
+SEGMENT_STAGE_MAX_BYTES = int(float(os.environ.get("MRIXAI_SEGMENT_STAGE_MB", "256")) * 1024 * 1024)
+# Thresholds a ThresholdTree resolves by lookup (the sensitivity slider's 0.01 steps)
+THRESHOLD_TREE_GRID = np.round(np.arange(101) / 100, 2)
+THRESHOLD_TREE_TOLERANCE = 1e-9
+# Per-session budget for cached surface meshes (3D view)
+MESH_CACHE_MAX_BYTES = int(float(os.environ.get("MRIXAI_MESH_CACHE_MB", "512")) * 1024 * 1024)
+# Default triangle budget per surface; the browser stays responsive well above this
+MESH_TRIANGLE_BUDGET = int(os.environ.get("MRIXAI_MESH_TRIANGLES", "200000"))
+# Voxels sampled by the pilot pass that estimates triangle counts
+MESH_PILOT_VOXELS = 1 << 18
+# Progressive rendering: budget of the preview surface drawn while the final one is extracted
+# in the background, and how often the page checks whether that has finished
+MESH_PREVIEW_TRIANGLES = 20000
+MESH_REFINE_POLL_SECONDS = 0.5
+# 3D view style presets, applied in the browser by the chart's own controls
+BRAIN_COLORS = {"Light Blue": "#ADD8E6", "Gray": "#D3D3D3", "Beige": "#F5F5DC", "Lavender": "#E6E6FA"}
+TUMOR_COLORS = {"Red": "#FF0000", "Orange": "#FFA500", "Yellow": "#FFFF00", "Magenta": "#FF00FF"}
+BRAIN_OPACITY = 0.2
+TUMOR_OPACITY = 0.6
+# Slice viewer: tumor overlay blend and per-session budget for encoded slice images
+MASK_OVERLAY_COLOR = (255, 0, 0)
+MASK_OVERLAY_ALPHA = 0.7
+SLICE_CACHE_MAX_BYTES = int(float(os.environ.get("MRIXAI_SLICE_CACHE_MB", "64")) * 1024 * 1024)
+# AI summaries: model, and the SQLite cache shared by every session on this host
+GEMINI_MODEL = 'gemini-2.0-flash'
+SUMMARY_CACHE_PATH = os.environ.get("MRIXAI_SUMMARY_CACHE_PATH", os.path.join(tempfile.gettempdir(), "mrixai_summary_cache.sqlite3"))
+SUMMARY_CACHE_TTL_SECONDS = float(os.environ.get("MRIXAI_SUMMARY_CACHE_TTL_HOURS", "168")) * 3600
+
+# Binary morphology implementation; every backend gives identical masks
+MORPHOLOGY_BACKENDS = ("scipy", "separable", "packed")
+MORPHOLOGY_BACKEND = os.environ.get("MRIXAI_MORPHOLOGY_BACKEND", "packed")
+
+# Worker processes for slab-parallel segmentation by callers of these functions; 1 keeps everything
+# in this process. Parallel segmentation is CLI-only: the page always segments serially (see the
+# safe_segment_tumor call in the page)
+SEGMENT_WORKERS = int(os.environ.get("MRIXAI_SEGMENT_WORKERS", "1"))
+# Smaller scans are segmented serially, where process start-up would outweigh the gain
+PARALLEL_MIN_VOXELS = int(os.environ.get("MRIXAI_PARALLEL_MIN_VOXELS", "4000000"))
+
+# Pipeline profiling: tracemalloc peak memory per stage, and the JSON-lines log of every run ("" disables it)
+PROFILE_MEMORY = os.environ.get("MRIXAI_PROFILE_MEMORY", "1") == "1"
+PROFILE_LOG_PATH = os.environ.get("MRIXAI_PROFILE_LOG", os.path.join(tempfile.gettempdir(), "mrixai_profile.jsonl"))
+
+@dataclass
+class StageTiming:
+    """Measurements of one pipeline stage; nested stages are included in their parent's"""
+    stage: str
+    depth: int
+    wall_seconds: float = 0.0
+    cpu_seconds: float = 0.0
+    # Peak traced allocation above the stage's starting point, for the whole process; None when
+    # memory was not traced or another profiled run overlapped the stage
+    process_peak_bytes: Optional[int] = None
+
+_active_profiler = contextvars.ContextVar("mrixai_profiler", default=None)
+
+class _TracemallocUsers:
+    """Reference count of the active profilers tracing memory.
+    
+    tracemalloc is process-wide and slows every Python allocation while on, so the
+    first profiler starts it and the last one stops it; concurrent sessions never
+    stop each other's tracing. Tracing started by someone else is left alone.
+    """
+    
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._count = 0
+        self._runs = 0  # acquisitions so far, identifying the current exclusive run
+    
+    def acquire(self) -> bool:
+        """Start tracing for one profiler; False if tracing is not ours to manage"""
+        with self._lock:
+            if self._count == 0:
+                if tracemalloc.is_tracing():
+                    return False
+                tracemalloc.start()
+            self._count += 1
+            self._runs += 1
+            return True
+    
+    def exclusive_run(self) -> Optional[int]:
+        """Id of the only profiled run tracing memory, or None while several are.
+        
+        A stage that sees the same id at its start and end had the peak to itself: no
+        other run reset it in between (reset_peak() is global) or started meanwhile.
+        """
+        with self._lock:
+            return self._runs if self._count == 1 else None
+    
+    def release(self):
+        with self._lock:
+            self._count -= 1
+            if self._count == 0:
+                tracemalloc.stop()
+
+# One counter per server process; the page's own globals are rebuilt on every rerun
+@st.cache_resource
+def _tracemalloc_users() -> _TracemallocUsers:
+    return _TracemallocUsers()
+
+class PipelineProfiler:
+    """Wall time, CPU time and peak allocated memory per stage of one pipeline run.
+    
+    Pipeline functions open stages with profile_stage(), which only records while a
+    profiler is activated in the calling context, so they run unchanged without one.
+    Memory comes from tracemalloc, which sees numpy buffers; like CPU time it is
+    process-wide, so other threads in the same process are counted too, and worker
+    processes are not. Peaks are only recorded for stages during which this was the
+    only profiled run tracing memory, so concurrent sessions never report each other's
+    allocations.
+    """
+    
+    def __init__(self, trace_memory: bool = PROFILE_MEMORY):
+        self.trace_memory = trace_memory
+        self.records: List[StageTiming] = []
+        self._peaks: List[int] = []  # highest traced memory seen so far by each open stage
+        self._users = None  # the tracemalloc counter while this run traces memory
+    
+    @contextmanager
+    def activate(self):
+        """Make this the profiler recorded into by profile_stage() in the current context,
+        tracing memory until the block ends"""
+        users = _tracemalloc_users() if self.trace_memory else None
+        traced = users is not None and users.acquire()
+        if traced:
+            self._users = users
+        token = _active_profiler.set(self)
+        try:
+            yield self
+        finally:
+            _active_profiler.reset(token)
+            if traced:
+                self._users = None
+                users.release()
+    
+    @contextmanager
+    def stage(self, name: str):
+        run = self._users.exclusive_run() if self._users is not None else None
+        tracing = run is not None
+        start_bytes = 0
+        if tracing:
+            # reset_peak() is global, so fold the peak so far into the enclosing stage first
+            start_bytes, peak = tracemalloc.get_traced_memory()
+            if self._peaks:
+                self._peaks[-1] = max(self._peaks[-1], peak)
+            tracemalloc.reset_peak()
+        record = StageTiming(name, len(self._peaks))
+        self.records.append(record)
+        self._peaks.append(start_bytes)
+        wall, cpu = time.perf_counter(), time.process_time()
+        try:
+            yield record
+        finally:
+            record.wall_seconds = time.perf_counter() - wall
+            record.cpu_seconds = time.process_time() - cpu
+            peak = self._peaks.pop()
+            if tracing and self._users is not None and self._users.exclusive_run() == run:
+                peak = max(peak, tracemalloc.get_traced_memory()[1])
+                record.process_peak_bytes = peak - start_bytes
+                if self._peaks:
+                    self._peaks[-1] = max(self._peaks[-1], peak)
+    
+    def to_list(self) -> List[dict]:
+        return [asdict(record) for record in self.records]
+    
+    def write_jsonl(self, path: str, **context):
+        """Append one JSON line per stage to `path`, tagged with a run id and `context`"""
+        run = {"run_id": uuid.uuid4().hex, "timestamp": time.time(), **context}
+        lines = "".join(json.dumps({**run, **record}) + "\n" for record in self.to_list())
+        with open(path, "a") as f:
+            f.write(lines)
+
+@contextmanager
+def profile_stage(name: str):
+    """Record the enclosed block as stage `name` on the active PipelineProfiler, if any"""
+    profiler = _active_profiler.get()
+    if profiler is None:
+        yield None
+        return
+    with profiler.stage(name) as record:
+        yield record
+
+def _iter_slabs(shape: Tuple[int, ...], depth: int = SLAB_DEPTH, axis: int = 2):
+    """Yield index tuples covering a volume in slabs of at most `depth` planes along `axis` (z by default)"""
+    if len(shape) < 3:
+        yield (Ellipsis,)
+        return
+    for start in range(0, shape[axis], depth):
+        yield _along(axis, slice(start, min(start + depth, shape[axis])))
+
+def _allocate_volume(shape: Tuple[int, ...], dtype, path: Optional[str] = None,
+                     fortran_order: bool = False) -> np.ndarray:
+    """Uninitialized array in memory, or a writable memory-mapped .npy at `path`"""
+    if path is None:
+        return np.empty(shape, dtype=dtype)
+    return np.lib.format.open_memmap(path, mode='w+', dtype=dtype, shape=tuple(shape), fortran_order=fortran_order)
+
+def _nifti_shape(file_path: str) -> Optional[Tuple[int, ...]]:
+    """Shape from a NIfTI header without reading the data; None for other formats or unreadable files"""
+    if not file_path.endswith((".nii.gz", ".nii")):
+        return None
     try:
-        # Normalize to 0-255 range
-        slice_norm = ((slice_2d - np.min(slice_2d)) / (np.max(slice_2d) - np.min(slice_2d)) * 255).astype(np.uint8)
-        # Apply CLAHE
-        enhanced = clahe.apply(slice_norm)
-        # Convert back to float64 and normalize
-        return enhanced.astype(np.float64) / 255.0
+        return tuple(nib.load(file_path).shape)
     except Exception:
-        return slice_2d
+        # safe_load_volume reports the error
+        return None
+
+def _load_nifti_volume(file_path: str, dtype_policy: str, out_path: Optional[str] = None,
+                       slab_depth: int = SLAB_DEPTH) -> np.ndarray:
+    """Load a NIfTI volume through nibabel's array proxy, scaling and cleaning it slab by slab.
+    
+    Converted volumes are written to a memory-mapped .npy at `out_path` when given.
+    """
+    # Uncompressed .nii files are memory-mapped; .nii.gz is decompressed once in its on-disk dtype
+    img = nib.load(file_path, mmap=True)
+    proxy = img.dataobj
+    if nib.is_proxy(proxy):
+        raw = proxy.get_unscaled()
+        slope, inter = float(proxy.slope), float(proxy.inter)
+    else:
+        raw = np.asanyarray(proxy)
+        slope, inter = 1.0, 0.0
+    
+    if raw.dtype.kind == 'V':
+        raise BrainAnalysisError(f"Unsupported NIfTI data type: {raw.dtype}")
+    
+    unscaled = slope == 1.0 and inter == 0.0
+    if dtype_policy == "native" and unscaled:
+        # Integer data cannot hold NaN/inf, so the proxy array is returned untouched
+        if raw.dtype.kind in 'biu':
+            return raw
+        # Float data is cleaned in place, only touching slabs that contain invalid values
+        volume = raw if raw.flags.writeable else np.array(raw)
+        for index in _iter_slabs(volume.shape):
+            block = volume[index]
+            if not np.all(np.isfinite(block)):
+                np.nan_to_num(block, copy=False, nan=0.0, posinf=1.0, neginf=0.0)
+        return volume
+    
+    out_dtype = np.float64 if dtype_policy == "float64" else np.float32
+    axis = _slab_axis(raw)
+    volume = _allocate_volume(raw.shape, out_dtype, out_path, fortran_order=axis == 2)
+    for index in _iter_slabs(raw.shape, slab_depth, axis):
+        block = raw[index].astype(out_dtype)
+        if slope != 1.0:
+            block *= slope
+        if inter != 0.0:
+            block += inter
+        # Handle any invalid values
+        volume[index] = np.nan_to_num(block, copy=False, nan=0.0, posinf=1.0, neginf=0.0)
+    return volume
 
-def safe_load_volume(file_path: str) -> Tuple[Optional[np.ndarray], Optional[str]]:
-    """Safely load volume data from file with proper type conversion"""
+def _decode_zip_image(zip_ref: zipfile.ZipFile, info: zipfile.ZipInfo) -> Optional[np.ndarray]:
+    """Decode one grayscale slice image from a zip member without extracting it"""
+    buffer = np.frombuffer(zip_ref.read(info), dtype=np.uint8)
+    return cv2.imdecode(buffer, cv2.IMREAD_GRAYSCALE)
+
+def safe_load_volume(file_path: str, dtype_policy: str = "float64", out_path: Optional[str] = None,
+                     slab_depth: int = SLAB_DEPTH) -> Tuple[Optional[np.ndarray], Optional[str]]:
+    """Safely load volume data from file, converting it according to `dtype_policy`.
+    
+    Converted volumes go to a memory-mapped .npy at `out_path` when given; arrays
+    returned as stored (native NIfTI data) are unaffected.
+    """
     try:
-        if file_path.endswith(".nii.gz"):
+        if dtype_policy not in VOLUME_DTYPE_POLICIES:
+            return None, f"Unknown dtype policy: {dtype_policy}"
+        
+        if file_path.endswith((".nii.gz", ".nii")):
             try:
-                # Load NIfTI file
-                img = nib.load(file_path)
-                # Get data and ensure it's float64
-                volume = img.get_fdata()
-                
-                # Handle different data types
-                if volume.dtype == np.dtype('V'):  # Void type
-                    volume = volume.astype(np.float64)
-                elif volume.dtype != np.float64:
-                    volume = volume.astype(np.float64)
-                
-                # Handle any invalid values
-                volume = np.nan_to_num(volume, nan=0.0, posinf=1.0, neginf=0.0)
-                
-                # Ensure the data is in a valid range
-                if np.any(np.isnan(volume)) or np.any(np.isinf(volume)):
-                    volume = np.nan_to_num(volume, nan=0.0, posinf=1.0, neginf=0.0)
-                
+                volume = _load_nifti_volume(file_path, dtype_policy, out_path, slab_depth)
                 return volume, None
                 
             except Exception as e:
@@ -75,36 +370,38 @@ def safe_load_volume(file_path: str) -> Tuple[Optional[np.ndarray], Optional[str
                 
         elif file_path.endswith(".zip"):
             try:
-                # Create temporary directory for extraction
-                with tempfile.TemporaryDirectory() as temp_dir:
-                    # Extract zip file
-                    with zipfile.ZipFile(file_path, 'r') as zip_ref:
-                        zip_ref.extractall(temp_dir)
+                with zipfile.ZipFile(file_path, 'r') as zip_ref:
+                    # Get list of image members, decoded straight from the archive
+                    image_members = sorted(
+                        (info for info in zip_ref.infolist()
+                         if not info.is_dir()
+                         and not info.filename.startswith('__MACOSX/')
+                         and info.filename.lower().endswith(('.jpg', '.png'))),
+                        key=lambda info: info.filename
+                    )
                     
-                    # Get list of image files
-                    image_files = sorted([f for f in os.listdir(temp_dir) 
-                                       if f.lower().endswith(('.jpg', '.png'))])
-                    
-                    if not image_files:
+                    if not image_members:
                         return None, "No valid images found in zip file"
                     
                     # Read first image to get dimensions
-                    first_img = cv2.imread(os.path.join(temp_dir, image_files[0]), 
-                                         cv2.IMREAD_GRAYSCALE)
+                    first_img = _decode_zip_image(zip_ref, image_members[0])
                     if first_img is None:
                         return None, "Error reading first image"
                     
-                    # Create empty volume array with float64 type
-                    volume = np.zeros((first_img.shape[0], first_img.shape[1], 
-                                     len(image_files)), dtype=np.float64)
+                    # Native policy keeps the 8-bit pixels, float policies scale them to 0-1
+                    out_dtype = {"float64": np.float64, "float32": np.float32, "native": np.uint8}[dtype_policy]
+                    shape = (first_img.shape[0], first_img.shape[1], len(image_members))
+                    # A new .npy memmap is zero-filled as well
+                    volume = np.zeros(shape, dtype=out_dtype) if out_path is None else _allocate_volume(shape, out_dtype, out_path)
                     
-                    # Read and process each image
-                    for i, fname in enumerate(image_files):
-                        img_path = os.path.join(temp_dir, fname)
-                        img = cv2.imread(img_path, cv2.IMREAD_GRAYSCALE)
+                    def decode_into(i):
+                        img = first_img if i == 0 else _decode_zip_image(zip_ref, image_members[i])
                         if img is not None:
-                            # Convert to float64 and normalize to 0-1
-                            volume[:,:,i] = img.astype(np.float64) / 255.0
+                            volume[:, :, i] = img if out_dtype == np.uint8 else img.astype(out_dtype) / 255.0
+                    
+                    # Decode slices concurrently; cv2.imdecode releases the GIL
+                    with ThreadPoolExecutor(max_workers=ZIP_DECODE_WORKERS) as executor:
+                        list(executor.map(decode_into, range(len(image_members))))
                     
                     return volume, None
                     
@@ -116,89 +413,1440 @@ def safe_load_volume(file_path: str) -> Tuple[Optional[np.ndarray], Optional[str
     except Exception as e:
         return None, f"Error loading volume: {str(e)}"
 
-def safe_normalize_volume(volume: np.ndarray) -> Tuple[Optional[np.ndarray], Optional[str]]:
-    """Safely normalize volume data with proper type handling"""
+def _normalized_dtype(dtype) -> type:
+    """float32 volumes stay float32, everything else is normalized in float64"""
+    return np.float32 if dtype == np.float32 else np.float64
+
+def safe_normalize_volume(volume: np.ndarray, out_path: Optional[str] = None,
+                          slab_depth: int = SLAB_DEPTH) -> Tuple[Optional[np.ndarray], Optional[str]]:
+    """Safely normalize volume data with proper type handling.
+    
+    The result is written to a memory-mapped .npy at `out_path` when given, laid out
+    like the source so both are read and written in contiguous slabs.
+    """
     try:
         if volume is None or volume.size == 0:
             return None, "Empty volume data"
         
-        # Ensure volume is float64
-        volume = volume.astype(np.float64)
+        out_dtype = _normalized_dtype(volume.dtype)
+        axis = _slab_axis(volume)
         
-        # Handle invalid values
-        volume = np.nan_to_num(volume, nan=0.0, posinf=1.0, neginf=0.0)
+        # Find the value range slab by slab instead of converting the whole volume up front
+        vmin, vmax = None, None
+        for index in _iter_slabs(volume.shape, slab_depth, axis):
+            block = np.nan_to_num(volume[index].astype(out_dtype), copy=False, nan=0.0, posinf=1.0, neginf=0.0)
+            block_min, block_max = np.min(block), np.max(block)
+            vmin = block_min if vmin is None else min(vmin, block_min)
+            vmax = block_max if vmax is None else max(vmax, block_max)
         
         # Check if volume is constant
-        vmin, vmax = np.min(volume), np.max(volume)
         if vmin == vmax:
             return None, "Volume has no variation (all values are the same)"
         
         # Normalize to 0-1 range
-        normalized = (volume - vmin) / (vmax - vmin)
-        return normalized.astype(np.float64), None
+        normalized = _allocate_volume(volume.shape, out_dtype, out_path, fortran_order=axis == 2)
+        for index in _iter_slabs(volume.shape, slab_depth, axis):
+            block = np.nan_to_num(volume[index].astype(out_dtype), copy=False, nan=0.0, posinf=1.0, neginf=0.0)
+            normalized[index] = (block - vmin) / (vmax - vmin)
+        if out_path is not None:
+            normalized.flush()
+        return normalized, None
         
     except Exception as e:
         return None, f"Error normalizing volume: {str(e)}"
 
-def safe_segment_tumor(volume: np.ndarray, threshold: float, min_size: int) -> Tuple[Optional[np.ndarray], Optional[str]]:
-    """Advanced brain tumor segmentation for 3D MRI"""
+def safe_clahe_volume(volume: np.ndarray, workers: int = CLAHE_WORKERS) -> Tuple[Optional[np.ndarray], Optional[str]]:
+    """CLAHE on every axial slice with process_slice, returning a uint8 volume.
+    
+    Slices run concurrently in a thread pool; each worker thread creates its CLAHE
+    object once (they are not safe to share between threads).
+    """
     try:
         if volume is None or volume.size == 0:
             return None, "Empty volume data"
         
+        enhanced = np.empty(volume.shape, dtype=np.uint8)
+        local = threading.local()
+        
+        def enhance(index: int):
+            if not hasattr(local, "clahe"):
+                local.clahe = cv2.createCLAHE(clipLimit=CLAHE_CLIP_LIMIT, tileGridSize=CLAHE_TILE_GRID)
+            enhanced[:, :, index] = process_slice((np.ascontiguousarray(volume[:, :, index]), local.clahe))
+        
+        with profile_stage("clahe"), ThreadPoolExecutor(max_workers=max(1, workers)) as executor:
+            list(executor.map(enhance, range(volume.shape[2])))
+        return enhanced, None
+    except Exception as e:
+        return None, f"Error in contrast enhancement: {str(e)}"
+
+class VolumeCache:
+    """Content-addressed on-disk cache of normalized volumes with LRU eviction.
+    
+    Volumes are stored as .npy files named by the SHA-256 of the source bytes and
+    memory-mapped read-only on reuse. File modification times track recency, so the
+    cache survives Streamlit reruns and is shared between sessions.
+    """
+    
+    def __init__(self, cache_dir: str = VOLUME_CACHE_DIR, max_bytes: int = VOLUME_CACHE_MAX_BYTES):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        os.makedirs(cache_dir, exist_ok=True)
+    
+    @staticmethod
+    def key_for_bytes(data, variant: str = "") -> str:
+        """Cache key for an in-memory upload"""
+        digest = hashlib.sha256(data).hexdigest()
+        return f"{digest}-{variant}" if variant else digest
+    
+    @staticmethod
+    def key_for_file(file_path: str, variant: str = "") -> str:
+        """Cache key for a file on disk, hashed in 1 MB chunks"""
+        sha = hashlib.sha256()
+        with open(file_path, 'rb') as f:
+            for chunk in iter(lambda: f.read(1024 * 1024), b''):
+                sha.update(chunk)
+        digest = sha.hexdigest()
+        return f"{digest}-{variant}" if variant else digest
+    
+    def _path(self, key: str) -> str:
+        return os.path.join(self.cache_dir, f"{key}.npy")
+    
+    def get(self, key: str) -> Optional[np.ndarray]:
+        """Return the cached volume as a read-only memmap, or None on a miss"""
+        path = self._path(key)
+        try:
+            volume = np.load(path, mmap_mode='r')
+            # Mark as most recently used
+            os.utime(path)
+            return volume
+        except (FileNotFoundError, ValueError, OSError):
+            return None
+    
+    def reserve(self, key: str) -> str:
+        """Private temp file in the cache directory to write an entry to; commit() publishes it.
+        
+        Writing to a temp file first means concurrent readers never see a partial .npy;
+        mkstemp names are unique per call, so sessions (threads) storing the same scan don't collide.
+        """
+        fd, temp_path = tempfile.mkstemp(dir=self.cache_dir, prefix=f"{key}.", suffix=".tmp")
+        os.close(fd)
+        return temp_path
+    
+    def commit(self, key: str, temp_path: str) -> np.ndarray:
+        """Publish a .npy written to a reserve()d temp file and return it memory-mapped"""
+        path = self._path(key)
+        try:
+            os.replace(temp_path, path)
+        except BaseException:
+            self.discard(temp_path)
+            raise
+        self._evict(keep=path)
+        return np.load(path, mmap_mode='r')
+    
+    @staticmethod
+    def discard(temp_path: str):
+        """Remove a reserve()d temp file that will not be committed"""
+        try:
+            os.remove(temp_path)
+        except OSError:
+            pass
+    
+    def put(self, key: str, volume: np.ndarray) -> np.ndarray:
+        """Store a volume and return its memory-mapped copy (or the volume itself if it does not fit)"""
+        if volume.nbytes > self.max_bytes:
+            return volume
+        temp_path = self.reserve(key)
+        try:
+            with open(temp_path, 'wb') as f:
+                np.save(f, np.ascontiguousarray(volume))
+        except BaseException:
+            self.discard(temp_path)
+            raise
+        return self.commit(key, temp_path)
+    
+    def _evict(self, keep: str):
+        """Remove least recently used entries until the cache fits its size budget"""
+        entries = []
+        for name in os.listdir(self.cache_dir):
+            if name.endswith('.npy'):
+                path = os.path.join(self.cache_dir, name)
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, path))
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            if path == keep:
+                continue
+            try:
+                os.remove(path)
+                total -= size
+            except OSError:
+                # Still mapped by another process on platforms that lock open files
+                continue
+
+def _exceeds_memory_budget(voxels: int, memory_budget: Optional[int]) -> bool:
+    """Whether segmenting this many voxels in memory would exceed the budget (None: no budget)"""
+    return memory_budget is not None and voxels * SEGMENT_BYTES_PER_VOXEL > memory_budget
+
+def safe_load_normalized_volume(file_path: str, dtype_policy: str = "float64",
+                                cache: Optional[VolumeCache] = None,
+                                cache_key: Optional[str] = None,
+                                memory_budget: Optional[int] = SEGMENT_MEMORY_BUDGET_BYTES) -> Tuple[Optional[np.ndarray], Optional[str]]:
+    """Load and normalize a volume, serving it from the volume cache when possible.
+    
+    Scans that will be segmented out-of-core under `memory_budget` never exist in RAM
+    as float arrays: they are converted and normalized slab by slab into a memory-mapped
+    .npy, the cache entry itself when it fits the cache, otherwise a temporary file that
+    is removed with the returned memmap.
+    """
+    work_dir, loaded_path, reserved = None, None, None
+    try:
+        if cache is not None:
+            if cache_key is None:
+                cache_key = VolumeCache.key_for_file(file_path, dtype_policy)
+            with profile_stage("volume_cache_read"):
+                cached = cache.get(cache_key)
+            if cached is not None:
+                return cached, None
+        
+        # The NIfTI header tells whether the float conversion in the loader must go to disk too
+        shape, slab_depth = _nifti_shape(file_path), SLAB_DEPTH
+        if shape is not None and _exceeds_memory_budget(int(np.prod(shape)), memory_budget):
+            work_dir = tempfile.mkdtemp(prefix="mrixai_volume_", dir=SEGMENT_WORK_DIR)
+            loaded_path = os.path.join(work_dir, "loaded.npy")
+            slab_depth = min(SLAB_DEPTH, _budget_slab_depth(shape, 2, memory_budget))
+        
+        with profile_stage("load"):
+            volume, error = safe_load_volume(file_path, dtype_policy, out_path=loaded_path, slab_depth=slab_depth)
+        if error:
+            return None, error
+        
+        out_path = None
+        if _exceeds_memory_budget(volume.size, memory_budget):
+            slab_depth = min(SLAB_DEPTH, choose_segment_slab_depth(volume, memory_budget))
+            if cache is not None and volume.size * np.dtype(_normalized_dtype(volume.dtype)).itemsize <= cache.max_bytes:
+                out_path = reserved = cache.reserve(cache_key)
+            else:
+                work_dir = work_dir or tempfile.mkdtemp(prefix="mrixai_volume_", dir=SEGMENT_WORK_DIR)
+                out_path = os.path.join(work_dir, "normalized.npy")
+        
+        with profile_stage("normalize"):
+            volume, error = safe_normalize_volume(volume, out_path, slab_depth)
+        if error:
+            return None, error
+        if loaded_path is not None and os.path.exists(loaded_path):
+            os.remove(loaded_path)
+        
+        if reserved is not None:
+            # Unmap the writable view before the file is renamed into place
+            del volume
+            with profile_stage("volume_cache_write"):
+                volume = cache.commit(cache_key, reserved)
+            reserved = None
+        elif out_path is not None:
+            weakref.finalize(volume, shutil.rmtree, work_dir, True)
+            work_dir = None
+        elif cache is not None:
+            with profile_stage("volume_cache_write"):
+                volume = cache.put(cache_key, volume)
+        return volume, None
+        
+    except Exception as e:
+        return None, f"Error loading volume: {str(e)}"
+    finally:
+        if reserved is not None:
+            VolumeCache.discard(reserved)
+        if work_dir is not None:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+class VolumeHandle:
+    """Serve single slices of a volume on demand without materializing it.
+    
+    The source can be any array-like with numpy basic slicing: an in-memory array,
+    a read-only memmap of a VolumeCache entry (only the pages behind the requested
+    slice are read) or a nibabel array proxy (O(slice) on .nii.gz when indexed_gzip
+    is installed).
+    """
+    
+    PLANE_AXES = {"sagittal": 0, "coronal": 1, "axial": 2}
+    
+    def __init__(self, source):
+        self._source = source
+    
+    @property
+    def shape(self) -> Tuple[int, ...]:
+        return tuple(self._source.shape)
+    
+    def num_slices(self, plane: str = "axial") -> int:
+        """Number of slices along the given plane's axis"""
+        return self.shape[self.PLANE_AXES[plane]]
+    
+    def get_slice(self, index: int, plane: str = "axial") -> np.ndarray:
+        """Read one 2D slice as an in-memory array"""
+        axis = self.PLANE_AXES[plane]
+        if not 0 <= index < self.shape[axis]:
+            raise IndexError(f"{plane} slice {index} out of range (0-{self.shape[axis] - 1})")
+        indexer = [slice(None)] * 3
+        indexer[axis] = index
+        return np.asarray(self._source[tuple(indexer)]).copy()
+
+def _new_region_sums(num_labels: int) -> dict:
+    return {
+        "volume": np.zeros(num_labels + 1, dtype=np.int64),
+        "intensity_sum": np.zeros(num_labels + 1, dtype=np.float64),
+        "coord_sum": np.zeros((3, num_labels + 1), dtype=np.float64),
+    }
+
+def _add_region_sums(sums: dict, labels_block: np.ndarray, intensity_block: np.ndarray, offset: Tuple[int, int, int]):
+    """Accumulate voxel counts, intensity sums and coordinate sums of a block whose corner sits at `offset`"""
+    flat = np.ravel(labels_block)
+    length = sums["volume"].size
+    sums["volume"] += np.bincount(flat, minlength=length)
+    sums["intensity_sum"] += np.bincount(flat, weights=np.ravel(intensity_block), minlength=length)
+    for axis in range(3):
+        grid_shape = [1, 1, 1]
+        grid_shape[axis] = labels_block.shape[axis]
+        coords = (np.arange(labels_block.shape[axis], dtype=np.float64) + offset[axis]).reshape(grid_shape)
+        sums["coord_sum"][axis] += np.bincount(flat, weights=np.broadcast_to(coords, labels_block.shape).ravel(), minlength=length)
+
+def _finish_region_table(sums: dict, objects: Optional[list] = None) -> dict:
+    """Turn accumulated sums (and optional find_objects slices) into the region table"""
+    volume = sums["volume"]
+    with np.errstate(invalid='ignore', divide='ignore'):
+        table = {
+            "volume": volume,
+            "mean_intensity": sums["intensity_sum"] / volume,
+            "centroid": (sums["coord_sum"] / volume).T,
+        }
+    if objects is not None:
+        bbox = np.zeros((volume.size, 3, 2), dtype=np.int64)
+        for label, slices in enumerate(objects, start=1):
+            if slices is not None:
+                bbox[label] = [(s.start, s.stop) for s in slices]
+        table["bbox"] = bbox
+        table["z_extent"] = bbox[:, 2, 1] - bbox[:, 2, 0]
+    return table
+
+def compute_region_table(labeled: np.ndarray, num_labels: int, intensity: np.ndarray) -> dict:
+    """Properties of every labeled region, computed in one vectorized pass.
+    
+    Arrays are indexed by label (0 is background): volume, mean_intensity,
+    centroid (N, 3), bbox (N, 3, 2) as [start, stop) per axis and z_extent.
+    """
+    sums = _new_region_sums(num_labels)
+    for start in range(0, labeled.shape[0], REGION_BLOCK_PLANES):
+        stop = start + REGION_BLOCK_PLANES
+        _add_region_sums(sums, labeled[start:stop], intensity[start:stop], (start, 0, 0))
+    return _finish_region_table(sums, ndimage.find_objects(labeled, max_label=num_labels))
+
+def _select_tumor_regions(table: dict, min_size: int, total_voxels: int) -> np.ndarray:
+    """Boolean keep-flag per label from the size and intensity rules"""
+    volume, mean_intensity = table["volume"], table["mean_intensity"]
+    keep = volume > min_size
+    keep[0] = False  # Remove background
+    keep &= ~((mean_intensity < 0.2) | (mean_intensity > 0.8) | (volume > total_voxels * 0.3))
+    return keep
+
+def _slice_area_counts(blocks, candidates: np.ndarray, num_labels: int, depth: int) -> np.ndarray:
+    """Per-z-slice voxel counts (candidates x depth) of each candidate label over (labels_block, z_offset) blocks"""
+    lookup = np.full(num_labels + 1, -1, dtype=np.int64)
+    lookup[candidates] = np.arange(candidates.size)
+    counts = np.zeros(candidates.size * depth, dtype=np.int64)
+    for labels_block, z_offset in blocks:
+        index = lookup[labels_block]
+        coords = np.nonzero(index >= 0)
+        counts += np.bincount(index[coords] * depth + coords[2] + z_offset, minlength=counts.size)
+    return counts.reshape(candidates.size, depth)
+
+def _max_slice_areas(blocks, candidates: np.ndarray, num_labels: int, depth: int) -> np.ndarray:
+    """Largest per-z-slice voxel count of each candidate label over (labels_block, z_offset) blocks"""
+    return _slice_area_counts(blocks, candidates, num_labels, depth).max(axis=1)
+
+def _along(axis: int, index) -> Tuple:
+    return (slice(None),) * axis + (index,)
+
+def _neighborhood_pass(mask: np.ndarray, axis: int, erode: bool) -> np.ndarray:
+    """Combine every element with its two neighbors along `axis` (outside the array counts as False)"""
+    out = mask.copy()
+    length = mask.shape[axis]
+    lower, upper = _along(axis, slice(0, length - 1)), _along(axis, slice(1, length))
+    if erode:
+        out[upper] &= mask[lower]
+        out[lower] &= mask[upper]
+        out[_along(axis, 0)] = 0
+        out[_along(axis, length - 1)] = 0
+    else:
+        out[upper] |= mask[lower]
+        out[lower] |= mask[upper]
+    return out
+
+def _packed_neighborhood_pass(packed: np.ndarray, erode: bool, tail: np.uint8) -> np.ndarray:
+    """_neighborhood_pass along the last axis of np.packbits output (big bit order)"""
+    following = np.zeros_like(packed)
+    following[..., :-1] = packed[..., 1:]
+    preceding = np.zeros_like(packed)
+    preceding[..., 1:] = packed[..., :-1]
+    from_next = (packed << 1) | (following >> 7)
+    from_previous = (packed >> 1) | (preceding << 7)
+    if erode:
+        return packed & from_next & from_previous
+    out = packed | from_next | from_previous
+    # Padding bits past the end of the axis must stay False
+    out[..., -1] &= tail
+    return out
+
+def binary_morphology(mask: np.ndarray, operations, structure: str = "box",
+                      backend: str = MORPHOLOGY_BACKEND) -> np.ndarray:
+    """Apply a sequence of "erode"/"dilate" steps to a 3D boolean mask.
+    
+    `structure` is "box" (3x3x3, as np.ones((3,3,3))) or "cross" (6-connected,
+    scipy's default), with border_value=0 like scipy. The "separable" backend
+    applies the box as three 1-D passes and the cross as one pass per axis on
+    bool arrays. "packed" does the same on masks bit-packed along the last axis.
+    Both give exactly the scipy result.
+    """
+    if backend not in MORPHOLOGY_BACKENDS:
+        raise ValueError(f"Unknown morphology backend: {backend}")
+    if backend == "scipy":
+        kernel = np.ones((3, 3, 3)) if structure == "box" else None
+        for operation in operations:
+            apply = ndimage.binary_erosion if operation == "erode" else ndimage.binary_dilation
+            mask = apply(mask, structure=kernel, iterations=1)
+        return mask
+    
+    length = mask.shape[-1]
+    if backend == "packed":
+        data = np.packbits(mask, axis=-1)
+        tail = np.uint8((0xFF << (-length % 8)) & 0xFF)
+    else:
+        data = np.asarray(mask, dtype=bool)
+    
+    def neighborhood(data: np.ndarray, axis: int, erode: bool) -> np.ndarray:
+        if backend == "packed" and axis == data.ndim - 1:
+            return _packed_neighborhood_pass(data, erode, tail)
+        return _neighborhood_pass(data, axis, erode)
+    
+    for operation in operations:
+        erode = operation == "erode"
+        if structure == "box":
+            for axis in range(data.ndim):
+                data = neighborhood(data, axis, erode)
+        else:
+            combined = neighborhood(data, 0, erode)
+            for axis in range(1, data.ndim):
+                if erode:
+                    combined &= neighborhood(data, axis, erode)
+                else:
+                    combined |= neighborhood(data, axis, erode)
+            data = combined
+    
+    if backend == "packed":
+        return np.unpackbits(data, axis=-1, count=length).view(bool)
+    return data
+
+def choose_segment_slab_depth(volume: np.ndarray, memory_budget: int = SEGMENT_MEMORY_BUDGET_BYTES) -> Optional[int]:
+    """Pick a slab depth that keeps segmentation within the memory budget, or None if the volume fits in memory"""
+    if not _exceeds_memory_budget(volume.size, memory_budget):
+        return None
+    return _budget_slab_depth(volume.shape, _slab_axis(volume), memory_budget)
+
+def _budget_slab_depth(shape: Tuple[int, ...], axis: int, memory_budget: int) -> int:
+    """Slab depth along `axis` whose halo-padded slabs fit the memory budget"""
+    plane_voxels = int(np.prod(shape)) // shape[axis]
+    return max(1, memory_budget // (plane_voxels * SEGMENT_BYTES_PER_VOXEL) - 2 * GAUSSIAN_HALO)
+
+def _slab_axis(volume: np.ndarray) -> int:
+    """Outermost axis in memory, so that each slab is one contiguous read (z for Fortran-ordered NIfTI data)"""
+    return 2 if volume.flags.f_contiguous and not volume.flags.c_contiguous else 0
+
+def _slab_index(axis: int, start: int, stop: int) -> Tuple[slice, ...]:
+    index = [slice(None)] * 3
+    index[axis] = slice(start, stop)
+    return tuple(index)
+
+def _iter_halo_slabs(length: int, slab_depth: int, halo: int):
+    """Yield (start, stop, padded_start, padded_stop) for slabs extended by `halo` planes on each side"""
+    for start in range(0, length, slab_depth):
+        stop = min(start + slab_depth, length)
+        yield start, stop, max(start - halo, 0), min(stop + halo, length)
+
+def _bin_index(values: np.ndarray, low: float, high: float, bins: int) -> np.ndarray:
+    if high <= low:
+        return np.zeros(values.shape, dtype=np.int64)
+    index = ((values - low) * (bins / (high - low))).astype(np.int64)
+    return np.clip(index, 0, bins - 1)
+
+def _window_members(block: np.ndarray, chain: Tuple, bins: int) -> np.ndarray:
+    """Select the values of a block that fall in a chain of nested histogram bins"""
+    members = np.ones(block.shape, dtype=bool)
+    for low, high, b in chain:
+        members &= (block >= low) & (block <= high) & (_bin_index(block, low, high, bins) == b)
+    return members
+
+def _streaming_order_statistics(data: np.ndarray, ranks, axis: int, slab_depth: int,
+                                data_range: Tuple[float, float], bins: int = STREAM_HISTOGRAM_BINS,
+                                max_candidates: int = STREAM_MAX_CANDIDATES) -> dict:
+    """Exact k-th smallest values of a disk-backed array using nested streaming histograms.
+    
+    Every pass reads the array slab by slab. A rank is resolved once its histogram bin
+    holds at most `max_candidates` values, which are gathered and sorted in memory;
+    larger bins are refined with a new histogram over their own value range.
+    """
+    length = data.shape[axis]
+    start_window = ((), float(data_range[0]), float(data_range[1]))
+    pending = {rank: (start_window, rank) for rank in ranks}
+    results = {}
+    while pending:
+        # Histogram pass, one histogram per distinct window
+        windows = {window for window, _ in pending.values()}
+        histograms = {window: np.zeros(bins, dtype=np.int64) for window in windows}
+        for start in range(0, length, slab_depth):
+            block = np.asarray(data[_slab_index(axis, start, start + slab_depth)])
+            for window in windows:
+                chain, low, high = window
+                values = block[_window_members(block, chain, bins)] if chain else block.ravel()
+                histograms[window] += np.bincount(_bin_index(values, low, high, bins), minlength=bins)
+        
+        # Locate the bin holding each rank; small bins are gathered, large ones refined
+        targets = {}
+        for rank, (window, local_rank) in pending.items():
+            chain, low, high = window
+            cumulative = np.cumsum(histograms[window])
+            b = int(np.searchsorted(cumulative, local_rank, side='right'))
+            below = int(cumulative[b - 1]) if b > 0 else 0
+            targets[rank] = (chain + ((low, high, b),), local_rank - below, histograms[window][b] <= max_candidates)
+        
+        gathered = {rank: [] for rank in targets}
+        for start in range(0, length, slab_depth):
+            block = np.asarray(data[_slab_index(axis, start, start + slab_depth)])
+            for rank, (chain, _, small) in targets.items():
+                values = block[_window_members(block, chain, bins)]
+                if small:
+                    gathered[rank].append(values)
+                elif values.size:
+                    gathered[rank].append(np.array([values.min(), values.max()]))
+        
+        pending = {}
+        for rank, (chain, local_rank, small) in targets.items():
+            values = np.concatenate(gathered[rank])
+            if small:
+                results[rank] = np.sort(values)[local_rank]
+            elif values.min() == values.max():
+                results[rank] = values.min()
+            else:
+                pending[rank] = ((chain, float(values.min()), float(values.max())), local_rank)
+    return results
+
+def _streaming_percentiles(data: np.ndarray, percentiles, axis: int, slab_depth: int,
+                           data_range: Tuple[float, float], max_candidates: int = STREAM_MAX_CANDIDATES) -> np.ndarray:
+    """np.percentile (linear method) of a disk-backed array without loading it"""
+    if data_range[0] == data_range[1]:
+        return np.full(len(percentiles), data_range[0], dtype=np.float64)
+    n = data.size
+    quantiles = np.true_divide(np.asarray(percentiles, dtype=np.float64), 100)
+    virtual = (n - 1) * quantiles
+    previous = np.floor(virtual).astype(np.int64)
+    following = np.minimum(previous + 1, n - 1)
+    gamma = virtual - previous
+    values = _streaming_order_statistics(data, sorted(set(previous) | set(following)), axis, slab_depth, data_range,
+                                         max_candidates=max_candidates)
+    a = np.array([values[r] for r in previous], dtype=np.float64)
+    b = np.array([values[r] for r in following], dtype=np.float64)
+    # Same interpolation as numpy's linear method
+    diff = b - a
+    return np.where(gamma >= 0.5, b - diff * (1 - gamma), a + diff * gamma)
+
+def _merge_label_equivalences(num_labels: int, pairs: np.ndarray) -> np.ndarray:
+    """Union-find over provisional labels; returns a lookup from provisional to consecutive final labels"""
+    parent = np.arange(num_labels + 1)
+    
+    def find(x):
+        root = x
+        while parent[root] != root:
+            root = parent[root]
+        while parent[x] != root:
+            parent[x], x = root, parent[x]
+        return root
+    
+    for a, b in pairs:
+        root_a, root_b = find(a), find(b)
+        if root_a != root_b:
+            parent[max(root_a, root_b)] = min(root_a, root_b)
+    
+    # Flatten every chain to its root, then renumber roots consecutively (background stays 0)
+    while True:
+        flattened = parent[parent]
+        if np.array_equal(flattened, parent):
+            break
+        parent = flattened
+    _, final = np.unique(parent, return_inverse=True)
+    return final
+
+def _label_slabs(source: np.ndarray, axis: int, slab_depth: int, labeled: np.ndarray) -> Tuple[np.ndarray, int]:
+    """Label a binary volume slab by slab into `labeled`, merging components that touch across slab faces.
+    
+    Returns the provisional-to-final label lookup and the number of final components.
+    """
+    num_labels, pairs, previous_face = 0, [], None
+    for start in range(0, source.shape[axis], slab_depth):
+        index = _slab_index(axis, start, start + slab_depth)
+        block, count = ndimage.label(np.asarray(source[index]))
+        block = block.astype(labeled.dtype, copy=False)
+        # Offset so labels are unique across slabs
+        block[block > 0] += num_labels
+        num_labels += count
+        labeled[index] = block
+        first_face = np.take(block, 0, axis=axis)
+        if previous_face is not None:
+            touching = (previous_face > 0) & (first_face > 0)
+            # Deduplicated per face: thin slabs would otherwise collect a pair per touching voxel
+            pairs.append(np.unique(np.stack([previous_face[touching], first_face[touching]], axis=1), axis=0))
+        previous_face = np.take(block, -1, axis=axis)
+    pairs = np.unique(np.concatenate(pairs), axis=0) if pairs else np.empty((0, 2), dtype=np.int64)
+    final = _merge_label_equivalences(num_labels, pairs)
+    return final, int(final.max())
+
+def _segment_tumor_slabs(volume: np.ndarray, threshold: float, min_size: int, slab_depth: int,
+                         morphology: str = MORPHOLOGY_BACKEND) -> np.ndarray:
+    """Out-of-core version of safe_segment_tumor working on halo-padded slabs.
+    
+    Intermediates live in memory-mapped files, so only a few slabs are resident at a
+    time. Halos cover the reach of each filter, percentiles come from streaming
+    histograms and components are stitched across slab boundaries with union-find,
+    which reproduces the in-memory result exactly. Returns a boolean memmap.
+    """
+    work_dir = tempfile.mkdtemp(prefix="mrixai_segment_", dir=SEGMENT_WORK_DIR)
+    shape, axis = volume.shape, _slab_axis(volume)
+    length = shape[axis]
+    order = 'F' if axis == 2 else 'C'
+    
+    def scratch(name, dtype):
+        return np.memmap(os.path.join(work_dir, f"{name}.dat"), dtype=dtype, mode='w+', shape=shape, order=order)
+    
+    try:
+        # 1. Gaussian smoothing, tracking the value range on the way
+        enhanced = scratch("enhanced", np.float64)
+        smin, smax = np.inf, -np.inf
+        for start, stop, lo, hi in _iter_halo_slabs(length, slab_depth, GAUSSIAN_HALO):
+            block = np.asarray(volume[_slab_index(axis, lo, hi)], dtype=np.float64)
+            smoothed = ndimage.gaussian_filter(block, sigma=1.0)[_slab_index(axis, start - lo, stop - lo)]
+            enhanced[_slab_index(axis, start, stop)] = smoothed
+            smin, smax = min(smin, smoothed.min()), max(smax, smoothed.max())
+        
+        # 2. Percentile normalization from streaming histograms, applied in place
+        # Bins gathered for sorting are capped at one slab's worth of values
+        slab_voxels = volume.size // length * slab_depth
+        vmin, vmax = _streaming_percentiles(enhanced, (1, 99), axis, slab_depth, (smin, smax),
+                                            max_candidates=min(STREAM_MAX_CANDIDATES, slab_voxels))
+        for start in range(0, length, slab_depth):
+            index = _slab_index(axis, start, start + slab_depth)
+            enhanced[index] = np.clip((enhanced[index] - vmin) / (vmax - vmin), 0, 1)
+        
+        # 3-4. Thresholding and morphology on halo-padded slabs
+        binary = scratch("binary", np.bool_)
+        for start, stop, lo, hi in _iter_halo_slabs(length, slab_depth, MORPHOLOGY_HALO):
+            block = np.asarray(enhanced[_slab_index(axis, lo, hi)]) > threshold
+            block = binary_morphology(block, ("erode", "dilate", "dilate", "erode"), backend=morphology)
+            binary[_slab_index(axis, start, stop)] = block[_slab_index(axis, start - lo, stop - lo)]
+        
+        # 5. Per-slab labeling stitched across slab faces
+        labeled = scratch("labeled", np.int32 if volume.size < 2**31 else np.int64)
+        final, num_final = _label_slabs(binary, axis, slab_depth, labeled)
+        
+        # 6. Region table accumulated slab by slab, then the same filtering rules as in memory
+        sums = _new_region_sums(num_final)
+        for start in range(0, length, slab_depth):
+            index = _slab_index(axis, start, start + slab_depth)
+            offset = [0, 0, 0]
+            offset[axis] = start
+            _add_region_sums(sums, final[labeled[index]], np.asarray(enhanced[index]), tuple(offset))
+        keep = _select_tumor_regions(_finish_region_table(sums), min_size, volume.size)
+        
+        candidates = np.flatnonzero(keep)
+        if candidates.size:
+            blocks = ((final[labeled[_slab_index(axis, start, start + slab_depth)]], start if axis == 2 else 0)
+                      for start in range(0, length, slab_depth))
+            areas = _max_slice_areas(blocks, candidates, num_final, shape[2])
+            keep[candidates[areas > shape[2] * 0.8]] = False
+        
+        # 7. Selected components
+        selected = scratch("selected", np.bool_)
+        for start in range(0, length, slab_depth):
+            index = _slab_index(axis, start, start + slab_depth)
+            selected[index] = keep[final[labeled[index]]]
+        
+        # 8. Final cleanup into the output mask
+        predicted_mask = scratch("mask", np.bool_)
+        for start, stop, lo, hi in _iter_halo_slabs(length, slab_depth, CLEANUP_HALO):
+            block = np.asarray(selected[_slab_index(axis, lo, hi)])
+            block = binary_morphology(block, ("dilate", "erode"), structure="cross", backend=morphology)
+            predicted_mask[_slab_index(axis, start, stop)] = block[_slab_index(axis, start - lo, stop - lo)]
+        predicted_mask.flush()
+        
+        del enhanced, binary, labeled, selected
+        for name in ("enhanced", "binary", "labeled", "selected"):
+            os.remove(os.path.join(work_dir, f"{name}.dat"))
+        # The mask file goes away once the returned memmap is garbage collected
+        weakref.finalize(predicted_mask, shutil.rmtree, work_dir, True)
+        return predicted_mask
+    except Exception:
+        shutil.rmtree(work_dir, ignore_errors=True)
+        raise
+
+# Shared memory segments opened by this worker process, kept open for the life of the worker
+_worker_shared_memory = {}
+
+def _attach_shared(specs: dict) -> dict:
+    """Numpy views of the shared arrays described by {key: (segment name, shape, dtype, order)}"""
+    arrays = {}
+    for key, (name, shape, dtype, order) in specs.items():
+        if name not in _worker_shared_memory:
+            _worker_shared_memory[name] = shared_memory.SharedMemory(name=name)
+        arrays[key] = np.ndarray(shape, dtype=dtype, buffer=_worker_shared_memory[name].buf, order=order)
+    return arrays
+
+def _parallel_smooth(specs: dict, axis: int, bounds: Tuple[int, int, int, int]):
+    start, stop, lo, hi = bounds
+    arrays = _attach_shared(specs)
+    block = np.asarray(arrays["volume"][_slab_index(axis, lo, hi)], dtype=np.float64)
+    arrays["enhanced"][_slab_index(axis, start, stop)] = ndimage.gaussian_filter(block, sigma=1.0)[_slab_index(axis, start - lo, stop - lo)]
+
+def _parallel_binary(specs: dict, axis: int, bounds: Tuple[int, int, int, int], vmin: float, vmax: float,
+                     threshold: float, morphology: str):
+    start, stop, lo, hi = bounds
+    arrays = _attach_shared(specs)
+    block = np.clip((arrays["enhanced"][_slab_index(axis, lo, hi)] - vmin) / (vmax - vmin), 0, 1) > threshold
+    block = binary_morphology(block, ("erode", "dilate", "dilate", "erode"), backend=morphology)
+    arrays["binary"][_slab_index(axis, start, stop)] = block[_slab_index(axis, start - lo, stop - lo)]
+
+def _parallel_label(specs: dict, axis: int, bounds: Tuple[int, int, int, int], vmin: float, vmax: float) -> int:
+    """Normalize the slab in place and label it with slab-local labels"""
+    start, stop, _, _ = bounds
+    arrays = _attach_shared(specs)
+    index = _slab_index(axis, start, stop)
+    arrays["enhanced"][index] = np.clip((arrays["enhanced"][index] - vmin) / (vmax - vmin), 0, 1)
+    labels, count = ndimage.label(arrays["binary"][index])
+    arrays["labeled"][index] = labels
+    return count
+
+def _parallel_regions(specs: dict, axis: int, bounds: Tuple[int, int, int, int], offset: int,
+                      final: np.ndarray) -> dict:
+    """Shift the slab to provisional labels and accumulate its region sums under the final labels"""
+    start, stop, _, _ = bounds
+    arrays = _attach_shared(specs)
+    index = _slab_index(axis, start, stop)
+    block = arrays["labeled"][index]
+    block[block > 0] += offset
+    corner = [0, 0, 0]
+    corner[axis] = start
+    sums = _new_region_sums(int(final.max()))
+    _add_region_sums(sums, final[block], arrays["enhanced"][index], tuple(corner))
+    return sums
+
+def _parallel_areas(specs: dict, axis: int, bounds: Tuple[int, int, int, int], final: np.ndarray,
+                    candidates: np.ndarray) -> np.ndarray:
+    start, stop, _, _ = bounds
+    arrays = _attach_shared(specs)
+    block = final[arrays["labeled"][_slab_index(axis, start, stop)]]
+    depth = arrays["labeled"].shape[2]
+    return _slice_area_counts([(block, start if axis == 2 else 0)], candidates, int(final.max()), depth)
+
+def _parallel_cleanup(specs: dict, axis: int, bounds: Tuple[int, int, int, int], selected: np.ndarray,
+                      morphology: str):
+    start, stop, lo, hi = bounds
+    arrays = _attach_shared(specs)
+    block = selected[arrays["labeled"][_slab_index(axis, lo, hi)]]
+    block = binary_morphology(block, ("dilate", "erode"), structure="cross", backend=morphology)
+    arrays["mask"][_slab_index(axis, start, stop)] = block[_slab_index(axis, start - lo, stop - lo)]
+
+def _can_fork_workers() -> bool:
+    """Slab-parallel workers are forked, which needs the fork start method and is only safe
+    while no other thread could hold a lock the child would inherit"""
+    return "fork" in multiprocessing.get_all_start_methods() and threading.active_count() == 1
+
+def _segment_tumor_parallel(volume: np.ndarray, threshold: float, min_size: int, workers: int,
+                            morphology: str = MORPHOLOGY_BACKEND) -> np.ndarray:
+    """In-memory segmentation split into one halo-padded slab per worker process.
+    
+    The volume and every intermediate live in shared memory, so workers only receive
+    segment names and slab bounds. Each stage runs on all slabs in parallel with the
+    same halos as the out-of-core path; this process computes the percentiles and
+    stitches slab-local labels across slab faces with union-find. The result is the
+    same as the serial path.
+    """
+    shape, axis = volume.shape, _slab_axis(volume)
+    length = shape[axis]
+    order = 'F' if axis == 2 else 'C'
+    slab_depth = -(-length // workers)
+    segments, specs = [], {}
+    
+    def shared(key, dtype):
+        dtype = np.dtype(dtype)
+        segment = shared_memory.SharedMemory(create=True, size=max(volume.size * dtype.itemsize, 1))
+        segments.append(segment)
+        specs[key] = (segment.name, shape, dtype.str, order)
+        return np.ndarray(shape, dtype=dtype, buffer=segment.buf, order=order)
+    
+    try:
+        source = shared("volume", volume.dtype)
+        source[...] = volume
+        enhanced = shared("enhanced", np.float64)
+        shared("binary", np.bool_)
+        labeled = shared("labeled", np.int32 if volume.size < 2**31 else np.int64)
+        mask = shared("mask", np.bool_)
+        
+        # Forked workers inherit this module, so the page's functions resolve without re-importing it
+        with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("fork")) as executor:
+            def run(function, halo, *args):
+                bounds = list(_iter_halo_slabs(length, slab_depth, halo))
+                futures = [executor.submit(function, specs, axis, b, *args) for b in bounds]
+                return bounds, [future.result() for future in futures]
+            
+            # 1. Gaussian smoothing
+            run(_parallel_smooth, GAUSSIAN_HALO)
+            
+            # 2. Percentiles of the smoothed volume
+            vmin, vmax = np.percentile(enhanced, (1, 99))
+            
+            # 3-4. Thresholding and morphology
+            run(_parallel_binary, MORPHOLOGY_HALO, vmin, vmax, threshold, morphology)
+            
+            # 5. Slab-local labels, stitched across slab faces
+            bounds, counts = run(_parallel_label, 0, vmin, vmax)
+            offsets = np.concatenate([[0], np.cumsum(counts)[:-1]])
+            pairs = []
+            for (_, stop, _, _), before, after in zip(bounds[:-1], offsets[:-1], offsets[1:]):
+                last_face = np.take(labeled, stop - 1, axis=axis).astype(np.int64)
+                first_face = np.take(labeled, stop, axis=axis).astype(np.int64)
+                touching = (last_face > 0) & (first_face > 0)
+                pairs.append(np.stack([last_face[touching] + before, first_face[touching] + after], axis=1))
+            pairs = np.unique(np.concatenate(pairs), axis=0) if pairs else np.empty((0, 2), dtype=np.int64)
+            final = _merge_label_equivalences(int(np.sum(counts)), pairs)
+            num_final = int(final.max())
+            
+            # 6. Region table from per-slab sums, then the usual filtering rules
+            futures = [executor.submit(_parallel_regions, specs, axis, b, int(offset), final)
+                       for b, offset in zip(bounds, offsets)]
+            sums = _new_region_sums(num_final)
+            for future in futures:
+                for key, values in future.result().items():
+                    sums[key] += values
+            keep = _select_tumor_regions(_finish_region_table(sums), min_size, volume.size)
+            candidates = np.flatnonzero(keep)
+            if candidates.size:
+                _, counts = run(_parallel_areas, 0, final, candidates)
+                areas = np.sum(counts, axis=0).max(axis=1)
+                keep[candidates[areas > shape[2] * 0.8]] = False
+            
+            # 7-8. Selected components and final cleanup
+            run(_parallel_cleanup, CLEANUP_HALO, keep[final], morphology)
+        
+        predicted_mask = mask.copy(order='K')
+        del source, enhanced, labeled, mask
+        return predicted_mask
+    finally:
+        for segment in segments:
+            try:
+                segment.close()
+            except BufferError:
+                # A view is still alive after an error; unlinking below frees the segment anyway
+                pass
+            segment.unlink()
+
+@dataclass
+class RegionStats:
+    """Per-component statistics of a final tumor mask, computed once per segmentation"""
+    volumes: np.ndarray           # (N,) voxels per component
+    bboxes: np.ndarray            # (N, 3, 2) [start, stop) per axis
+    centroids: np.ndarray         # (N, 3) voxel coordinates
+    mean_intensities: np.ndarray  # (N,)
+    max_intensities: np.ndarray   # (N,)
+    total_voxels: int             # voxels in the whole scan
+    
+    @property
+    def num_components(self) -> int:
+        return int(self.volumes.size)
+    
+    @property
+    def tumor_volume(self) -> int:
+        return int(self.volumes.sum())
+    
+    @property
+    def tumor_percentage(self) -> float:
+        return self.tumor_volume / self.total_voxels * 100 if self.total_voxels > 0 else 0.0
+    
+    @property
+    def extent(self) -> Optional[List[int]]:
+        """Size of the bounding box around all components, per axis"""
+        if not self.num_components:
+            return None
+        return [int(self.bboxes[:, axis, 1].max() - self.bboxes[:, axis, 0].min()) for axis in range(3)]
+    
+    @property
+    def center(self) -> Optional[List[float]]:
+        """Mean voxel coordinate over all components"""
+        if not self.num_components:
+            return None
+        return list(np.average(self.centroids, axis=0, weights=self.volumes))
+    
+    @property
+    def mean_intensity(self) -> float:
+        return float(np.average(self.mean_intensities, weights=self.volumes)) if self.num_components else 0.0
+    
+    @property
+    def max_intensity(self) -> float:
+        return float(self.max_intensities.max()) if self.num_components else 0.0
+    
+    def to_dict(self) -> dict:
+        """Plain-Python form for plugin results and JSON"""
+        return {
+            "num_components": self.num_components,
+            "tumor_volume": self.tumor_volume,
+            "tumor_percentage": self.tumor_percentage,
+            "total_voxels": self.total_voxels,
+            "extent": self.extent,
+            "center": self.center,
+            "mean_intensity": self.mean_intensity,
+            "max_intensity": self.max_intensity,
+            "components": [
+                {
+                    "volume": int(self.volumes[i]),
+                    "bbox": self.bboxes[i].tolist(),
+                    "centroid": self.centroids[i].tolist(),
+                    "mean_intensity": float(self.mean_intensities[i]),
+                    "max_intensity": float(self.max_intensities[i]),
+                }
+                for i in range(self.num_components)
+            ],
+        }
+
+@dataclass
+class CompactMask:
+    """Serializable binary mask: the foreground bounding box, run-length encoded.
+    
+    `runs` holds alternating background/foreground run lengths over the C-order
+    flattened bbox crop, starting with a (possibly empty) background run, so a
+    mask costs a few bytes per run instead of one or eight bytes per voxel.
+    """
+    shape: Tuple[int, ...]
+    bbox: Optional[np.ndarray]  # (3, 2) [start, stop) per axis, None for an empty mask
+    runs: np.ndarray            # run lengths
+    
+    @classmethod
+    def from_mask(cls, mask: np.ndarray) -> "CompactMask":
+        """Encode any array-like mask (nonzero is foreground), reading it slab by slab"""
+        shape = tuple(mask.shape)
+        occupied = [np.zeros(size, dtype=bool) for size in shape]
+        for index in _iter_slabs(shape):
+            block = np.asarray(mask[index]).astype(bool, copy=False)
+            for axis in range(len(shape)):
+                occupied[axis][index[axis]] |= block.any(axis=tuple(a for a in range(len(shape)) if a != axis))
+        if not occupied[0].any():
+            return cls(shape, None, np.zeros(0, dtype=np.uint32))
+        bbox = np.array([[np.argmax(o), o.size - np.argmax(o[::-1])] for o in occupied], dtype=np.int64)
+        flat = np.asarray(mask[tuple(slice(start, stop) for start, stop in bbox)]).astype(bool, copy=False).ravel()
+        edges = np.concatenate([[0], np.flatnonzero(flat[1:] != flat[:-1]) + 1, [flat.size]])
+        runs = np.diff(edges)
+        # Runs start with background, so a crop opening on foreground gets an empty first run
+        if flat[0]:
+            runs = np.concatenate([[0], runs])
+        return cls(shape, bbox, runs.astype(np.uint32 if flat.size < 2**32 else np.uint64))
+    
+    @property
+    def tumor_volume(self) -> int:
+        return int(self.runs[1::2].sum())
+    
+    @property
+    def nbytes(self) -> int:
+        return int(self.runs.nbytes) + (int(self.bbox.nbytes) if self.bbox is not None else 0)
+    
+    def to_mask(self) -> np.ndarray:
+        """Decode to a boolean array"""
+        mask = np.zeros(self.shape, dtype=bool)
+        if self.bbox is not None:
+            crop = tuple(slice(start, stop) for start, stop in self.bbox)
+            values = np.zeros(self.runs.size, dtype=bool)
+            values[1::2] = True
+            mask[crop] = np.repeat(values, self.runs).reshape(mask[crop].shape)
+        return mask
+    
+    def to_dict(self) -> dict:
+        return {
+            "shape": list(self.shape),
+            "bbox": self.bbox.tolist() if self.bbox is not None else None,
+            "runs": self.runs.tolist(),
+        }
+    
+    @classmethod
+    def from_dict(cls, data: dict) -> "CompactMask":
+        bbox = np.asarray(data["bbox"], dtype=np.int64) if data["bbox"] is not None else None
+        return cls(tuple(data["shape"]), bbox, np.asarray(data["runs"], dtype=np.uint64 if np.prod(data["shape"]) >= 2**32 else np.uint32))
+
+def _region_stats_slabs(mask: np.ndarray, intensity: np.ndarray, slab_depth: int) -> RegionStats:
+    """Slab-wise RegionStats for masks too large to label in memory"""
+    work_dir = tempfile.mkdtemp(prefix="mrixai_stats_", dir=SEGMENT_WORK_DIR)
+    axis = _slab_axis(mask)
+    try:
+        labeled = np.memmap(os.path.join(work_dir, "labeled.dat"), dtype=np.int32 if mask.size < 2**31 else np.int64,
+                            mode='w+', shape=mask.shape, order='F' if axis == 2 else 'C')
+        final, num_final = _label_slabs(mask, axis, slab_depth, labeled)
+        sums = _new_region_sums(num_final)
+        max_intensities = np.full(num_final, -np.inf)
+        bboxes = np.zeros((num_final, 3, 2), dtype=np.int64)
+        bboxes[:, :, 0] = np.iinfo(np.int64).max
+        for start in range(0, mask.shape[axis], slab_depth):
+            index = _slab_index(axis, start, start + slab_depth)
+            block = final[labeled[index]]
+            block_intensity = np.asarray(intensity[index])
+            offset = [0, 0, 0]
+            offset[axis] = start
+            _add_region_sums(sums, block, block_intensity, tuple(offset))
+            present = np.unique(block[block > 0])
+            if present.size:
+                np.maximum.at(max_intensities, present - 1, ndimage.maximum(block_intensity, block, present))
+            # Grow each component's bounding box by its extent within this slab
+            for label, slices in enumerate(ndimage.find_objects(block, max_label=num_final), start=1):
+                if slices is not None:
+                    starts = [s.start + o for s, o in zip(slices, offset)]
+                    stops = [s.stop + o for s, o in zip(slices, offset)]
+                    bboxes[label - 1, :, 0] = np.minimum(bboxes[label - 1, :, 0], starts)
+                    bboxes[label - 1, :, 1] = np.maximum(bboxes[label - 1, :, 1], stops)
+        del labeled
+        table = _finish_region_table(sums)
+        return RegionStats(
+            volumes=table["volume"][1:],
+            bboxes=bboxes,
+            centroids=table["centroid"][1:],
+            mean_intensities=table["mean_intensity"][1:],
+            max_intensities=max_intensities,
+            total_voxels=int(mask.size),
+        )
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+def safe_region_stats(mask: np.ndarray, intensity: np.ndarray,
+                      slab_depth: Optional[int] = None) -> Tuple[Optional[RegionStats], Optional[str]]:
+    """Label the final mask once and collect RegionStats from `intensity` (the normalized volume)"""
+    try:
+        if mask is None or intensity is None:
+            return None, "Missing mask or volume for region statistics"
+        with profile_stage("region_stats"):
+            if slab_depth is not None:
+                return _region_stats_slabs(mask, intensity, slab_depth), None
+        
+            labeled, num_components = ndimage.label(mask)
+            table = compute_region_table(labeled, num_components, intensity)
+            index = np.arange(1, num_components + 1)
+            max_intensities = np.asarray(ndimage.maximum(intensity, labeled, index), dtype=np.float64) if num_components else np.zeros(0)
+            return RegionStats(
+                volumes=table["volume"][1:],
+                bboxes=table["bbox"][1:],
+                centroids=table["centroid"][1:],
+                mean_intensities=table["mean_intensity"][1:],
+                max_intensities=max_intensities,
+                total_voxels=int(mask.size),
+            ), None
+    except Exception as e:
+        return None, f"Error computing region statistics: {str(e)}"
+
+def _enhance_volume(volume: np.ndarray) -> np.ndarray:
+    """Segmentation stage 1: smoothing and percentile contrast stretch (threshold independent)"""
+    with profile_stage("smoothing"):
         # Ensure volume is float64
         volume_float = volume.astype(np.float64)
         
+        # 1. Brain-specific preprocessing
+        smoothed = ndimage.gaussian_filter(volume_float, sigma=1.0)
+        
+        # 2. Brain-specific normalization
+        vmin, vmax = np.percentile(smoothed, (1, 99))
+        return np.clip((smoothed - vmin) / (vmax - vmin), 0, 1)
+
+def _label_components(enhanced: np.ndarray, threshold: float,
+                      morphology: str = MORPHOLOGY_BACKEND) -> Tuple[np.ndarray, int, dict]:
+    """Segmentation stage 2: threshold, morphology, labeling and the region table (min_size independent).
+    
+    The table also carries max_slice_area for every label that passes the intensity
+    rules, so stage 3 can apply any min_size without touching the voxels again.
+    """
+    with profile_stage("morphology"):
+        # 3. Brain-specific tumor detection
+        binary = enhanced > threshold
+        
+        # 4. Brain-specific morphological operations (opening, then closing)
+        binary = binary_morphology(binary, ("erode", "dilate", "dilate", "erode"), backend=morphology)
+    
+    with profile_stage("labeling"):
+        # 5. Connected component analysis
+        labeled, num_features = ndimage.label(binary)
+        regions = compute_region_table(labeled, num_features, enhanced)
+        _add_max_slice_areas(regions, [(labeled, 0)], enhanced.shape)
+    return labeled, num_features, regions
+
+def _add_max_slice_areas(regions: dict, blocks, shape: Tuple[int, int, int]):
+    """Store max_slice_area in the region table for every label passing the intensity rules"""
+    num_features = regions["volume"].size - 1
+    plausible = np.flatnonzero(_select_tumor_regions(regions, 0, int(np.prod(shape))))
+    regions["max_slice_area"] = np.zeros(num_features + 1, dtype=np.int64)
+    if plausible.size:
+        regions["max_slice_area"][plausible] = _max_slice_areas(blocks, plausible, num_features, shape[2])
+
+def _tumor_keep_flags(regions: dict, min_size: int, shape: Tuple[int, int, int]) -> np.ndarray:
+    """Keep-flag per label: the size/intensity rules plus the per-slice extent rule"""
+    keep = _select_tumor_regions(regions, min_size, int(np.prod(shape)))
+    keep &= ~(regions["max_slice_area"] > shape[2] * 0.8)
+    return keep
+
+def _filter_components(labeled: np.ndarray, regions: dict, min_size: int,
+                       morphology: str = MORPHOLOGY_BACKEND) -> np.ndarray:
+    """Segmentation stage 3: keep the tumor-like regions and clean up the boolean mask.
+    
+    The cleanup only runs on the bounding box of the kept regions padded by
+    CLEANUP_HALO, outside of which the mask is empty either way.
+    """
+    with profile_stage("region_filter"):
+        # 6. Brain-specific filtering, vectorized over the region table
+        mask_sizes = _tumor_keep_flags(regions, min_size, labeled.shape)
+        
+        predicted_mask = np.zeros(labeled.shape, dtype=bool)
+        kept = np.flatnonzero(mask_sizes)
+        if not kept.size:
+            return predicted_mask
+        bbox = regions["bbox"][kept]
+        crop = tuple(
+            slice(max(int(bbox[:, axis, 0].min()) - CLEANUP_HALO, 0),
+                  min(int(bbox[:, axis, 1].max()) + CLEANUP_HALO, labeled.shape[axis]))
+            for axis in range(3)
+        )
+        
+        # 7. Create final mask
+        cropped = mask_sizes[labeled[crop]]
+    
+    with profile_stage("cleanup"):
+        # 8. Final cleanup
+        predicted_mask[crop] = binary_morphology(cropped, ("dilate", "erode"), structure="cross", backend=morphology)
+    return predicted_mask
+
+def _volume_key(volume: np.ndarray) -> str:
+    """SHA-256 of an in-memory volume, for callers without a VolumeCache key"""
+    digest = hashlib.sha256(f"{volume.shape}|{volume.dtype.str}|".encode())
+    for index in _iter_slabs(volume.shape):
+        digest.update(np.ascontiguousarray(volume[index]).data)
+    return digest.hexdigest()
+
+class ThresholdTree:
+    """Component tree of the enhanced volume over a grid of thresholds.
+    
+    Thresholding commutes with flat grey-scale morphology, so the opened and
+    closed mask at threshold t is exactly `closing(opening(enhanced)) > t`. The
+    components of these nested level sets are labeled once per grid threshold
+    and linked to their parent one level down. Each voxel stores its deepest
+    component, so the labeling and region table at any grid threshold are
+    lookups instead of a new segmentation.
+    """
+    
+    def __init__(self, enhanced: np.ndarray, thresholds=THRESHOLD_TREE_GRID):
+        self.thresholds = np.unique(np.asarray(thresholds, dtype=np.float64))
+        self.shape = enhanced.shape
+        
+        # Grey-level opening and closing; -inf outside matches border_value=0 of the binary operations
+        levels = ndimage.grey_opening(enhanced, size=(3, 3, 3), mode='constant', cval=-np.inf)
+        levels = ndimage.grey_closing(levels, size=(3, 3, 3), mode='constant', cval=-np.inf)
+        # Number of grid thresholds each voxel exceeds
+        depth = np.searchsorted(self.thresholds, levels, side='left').astype(np.uint16)
+        del levels
+        
+        # Label the level sets from the highest threshold down, linking each component to its parent
+        count = self.thresholds.size
+        plane_depth = [depth.max(axis=tuple(a for a in range(3) if a != axis)) for axis in range(3)]
+        self.leaf = np.zeros(self.shape, dtype=np.int32)
+        self.num_labels = [0] * count
+        self.parents = [np.zeros(1, dtype=np.int32) for _ in range(count)]
+        self._offsets = [0] * count
+        self._crops = [None] * count
+        total, child = 0, None
+        for level in range(count - 1, -1, -1):
+            crop = self._level_crop(plane_depth, level)
+            if crop is None:
+                continue
+            labeled, num = ndimage.label(depth[crop] > level)
+            if child is not None:
+                child_labels, child_crop = child
+                inner = tuple(slice(c.start - p.start, c.stop - p.start) for c, p in zip(child_crop, crop))
+                present = child_labels > 0
+                self.parents[level] = np.zeros(self.num_labels[level + 1] + 1, dtype=np.int32)
+                self.parents[level][child_labels[present]] = labeled[inner][present]
+            own = depth[crop] == level + 1
+            self.leaf[crop][own] = total + labeled[own]
+            self.num_labels[level], self._offsets[level], self._crops[level] = num, total, crop
+            total += num
+            child = (labeled, crop)
+        del depth, child
+        
+        # Sums and bounding boxes over each component's own voxels, then accumulated into every ancestor
+        sums = _new_region_sums(total)
+        for start in range(0, self.shape[0], REGION_BLOCK_PLANES):
+            stop = start + REGION_BLOCK_PLANES
+            _add_region_sums(sums, self.leaf[start:stop], enhanced[start:stop], (start, 0, 0))
+        grand_total = {key: values.sum(axis=-1) for key, values in sums.items()}
+        lower = np.full((total + 1, 3), np.iinfo(np.int64).max, dtype=np.int64)
+        upper = np.zeros((total + 1, 3), dtype=np.int64)
+        for node, slices in enumerate(ndimage.find_objects(self.leaf, max_label=total), start=1):
+            if slices is not None:
+                lower[node] = [s.start for s in slices]
+                upper[node] = [s.stop for s in slices]
+        for level in range(count - 1, 0, -1):
+            if self.num_labels[level]:
+                children = self._node_ids(level)
+                ancestors = self._offsets[level - 1] + self.parents[level - 1][1:]
+                for values in sums.values():
+                    np.add.at(values, (..., ancestors), values[..., children])
+                np.minimum.at(lower, ancestors, lower[children])
+                np.maximum.at(upper, ancestors, upper[children])
+        
+        self.regions = []
+        for level in range(count):
+            ids = self._node_ids(level)
+            level_sums = {}
+            for key, values in sums.items():
+                background = grand_total[key] - values[..., ids].sum(axis=-1)
+                level_sums[key] = np.concatenate([background[..., None], values[..., ids]], axis=-1)
+            regions = _finish_region_table(level_sums)
+            regions["bbox"] = np.zeros((ids.size + 1, 3, 2), dtype=np.int64)
+            regions["bbox"][1:, :, 0], regions["bbox"][1:, :, 1] = lower[ids], upper[ids]
+            regions["z_extent"] = regions["bbox"][:, 2, 1] - regions["bbox"][:, 2, 0]
+            if self.num_labels[level]:
+                crop = self._crops[level]
+                labeled = self._level_lookup(level)[self.leaf[crop]]
+                _add_max_slice_areas(regions, [(labeled, crop[2].start)], self.shape)
+            else:
+                regions["max_slice_area"] = np.zeros(1, dtype=np.int64)
+            self.regions.append(regions)
+    
+    @staticmethod
+    def _level_crop(plane_depth, level: int) -> Optional[Tuple[slice, ...]]:
+        crop = []
+        for planes in plane_depth:
+            inside = np.flatnonzero(planes > level)
+            if not inside.size:
+                return None
+            crop.append(slice(int(inside[0]), int(inside[-1]) + 1))
+        return tuple(crop)
+    
+    def _node_ids(self, level: int) -> np.ndarray:
+        return np.arange(self._offsets[level] + 1, self._offsets[level] + self.num_labels[level] + 1)
+    
+    def _level_lookup(self, level: int) -> np.ndarray:
+        """Map from every component id to its ancestor's label at `level` (0 below it)"""
+        lookup = np.zeros(int(self.leaf.max()) + 1, dtype=np.int32)
+        lookup[self._node_ids(level)] = np.arange(1, self.num_labels[level] + 1)
+        for deeper in range(level + 1, self.thresholds.size):
+            if not self.num_labels[deeper]:
+                break
+            lookup[self._node_ids(deeper)] = lookup[self._offsets[deeper - 1] + self.parents[deeper - 1][1:]]
+        return lookup
+    
+    def level(self, threshold: float) -> Optional[int]:
+        """Grid index of `threshold`, or None when it is not on the grid"""
+        index = int(np.argmin(np.abs(self.thresholds - threshold)))
+        if abs(self.thresholds[index] - threshold) > THRESHOLD_TREE_TOLERANCE:
+            return None
+        return index
+    
+    def components(self, threshold: float) -> Tuple[np.ndarray, int, dict]:
+        """Same (labeled, num_features, regions) as the direct segmentation at a grid threshold"""
+        level = self.level(threshold)
+        if level is None:
+            raise ValueError(f"Threshold {threshold} is not on the precomputed grid")
+        return self._level_lookup(level)[self.leaf], self.num_labels[level], self.regions[level]
+    
+    def volume_curve(self, min_size: int) -> Tuple[np.ndarray, np.ndarray]:
+        """Tumor volume (kept regions, before the final cleanup) at every grid threshold"""
+        volumes = np.array([
+            int(regions["volume"][_tumor_keep_flags(regions, min_size, self.shape)].sum())
+            for regions in self.regions
+        ])
+        return self.thresholds, volumes
+
+class SegmentationStages:
+    """Memoized stages of the in-memory segmentation.
+    
+    Stage results are keyed by the volume key plus only the parameters they depend
+    on, so changing the threshold skips smoothing and normalization, and changing
+    min_size only re-filters the cached region table. Each stage keeps the
+    `max_entries` most recently used parameter sets, and all stages together stay
+    within `max_bytes` by dropping the least recently used results of any stage
+    (the result just computed is always kept). Final masks are held as CompactMask.
+    Keep one instance per user session (e.g. in st.session_state) and pass it to
+    safe_segment_tumor.
+    """
+    
+    def __init__(self, max_entries: int = SEGMENT_STAGE_ENTRIES, max_bytes: int = SEGMENT_STAGE_MAX_BYTES):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self._stages = {}
+        self._sizes = OrderedDict()  # (stage, key) -> bytes, least recently used first
+        self._nbytes = 0
+    
+    @staticmethod
+    def _size(value) -> int:
+        """Bytes of the arrays held by a stage result"""
+        if isinstance(value, np.ndarray):
+            return int(value.nbytes)
+        if isinstance(value, (tuple, list)):
+            return sum(SegmentationStages._size(item) for item in value)
+        if isinstance(value, dict):
+            return sum(SegmentationStages._size(item) for item in value.values())
+        if hasattr(value, "__dict__"):
+            return SegmentationStages._size(vars(value))
+        return 0
+    
+    def _touch(self, stage: str, key: tuple):
+        self._stages[stage].move_to_end(key)
+        self._sizes.move_to_end((stage, key))
+    
+    def _drop(self, stage: str, key: tuple):
+        del self._stages[stage][key]
+        self._nbytes -= self._sizes.pop((stage, key))
+    
+    def _memo(self, stage: str, key: tuple, compute):
+        entries = self._stages.setdefault(stage, OrderedDict())
+        if key in entries:
+            self._touch(stage, key)
+            return entries[key]
+        value = compute()
+        entries[key] = value
+        self._sizes[(stage, key)] = self._size(value)
+        self._nbytes += self._sizes[(stage, key)]
+        while len(entries) > self.max_entries:
+            self._drop(stage, next(iter(entries)))
+        while self._nbytes > self.max_bytes and len(self._sizes) > 1:
+            self._drop(*next(iter(self._sizes)))
+        return value
+    
+    def enhanced(self, volume: np.ndarray, volume_key: str) -> np.ndarray:
+        return self._memo("enhanced", (volume_key,), lambda: _enhance_volume(volume))
+    
+    def components(self, volume: np.ndarray, volume_key: str, threshold: float,
+                   morphology: str = MORPHOLOGY_BACKEND) -> Tuple[np.ndarray, int, dict]:
+        def compute():
+            # A precomputed threshold tree of this volume answers grid thresholds by lookup
+            for tree_key, tree in self._stages.get("tree", {}).items():
+                if tree_key[0] == volume_key and tree.level(threshold) is not None:
+                    # Keep the tree ahead of older results when the budget is tight
+                    self._touch("tree", tree_key)
+                    return tree.components(threshold)
+            return _label_components(self.enhanced(volume, volume_key), threshold, morphology)
+        return self._memo("components", (volume_key, threshold), compute)
+    
+    def tree(self, volume: np.ndarray, volume_key: str, thresholds=THRESHOLD_TREE_GRID) -> ThresholdTree:
+        return self._memo(
+            "tree", (volume_key, tuple(thresholds)),
+            lambda: ThresholdTree(self.enhanced(volume, volume_key), thresholds)
+        )
+    
+    def mask(self, volume: np.ndarray, volume_key: str, threshold: float, min_size: int,
+             morphology: str = MORPHOLOGY_BACKEND, compute=None) -> np.ndarray:
+        """Final mask; `compute` may produce it another way with the same result (e.g. in parallel)"""
+        def staged():
+            labeled, _, regions = self.components(volume, volume_key, threshold, morphology)
+            return _filter_components(labeled, regions, min_size, morphology)
+        compact = self._memo("mask", (volume_key, threshold, min_size),
+                             lambda: CompactMask.from_mask((compute or staged)()))
+        return compact.to_mask()
+    
+    def clear(self):
+        self._stages.clear()
+        self._sizes.clear()
+        self._nbytes = 0
+
+def safe_threshold_tree(volume: np.ndarray, stages: Optional[SegmentationStages] = None,
+                        volume_key: Optional[str] = None,
+                        thresholds=THRESHOLD_TREE_GRID) -> Tuple[Optional[ThresholdTree], Optional[str]]:
+    """Precompute the ThresholdTree of a volume for threshold sweeps
+    
+    With `stages`, the tree is memoized there and later safe_segment_tumor calls
+    with the same stages and a grid threshold are served from it.
+    """
+    try:
+        if volume is None or volume.size == 0:
+            return None, "Empty volume data"
+        with profile_stage("threshold_tree"):
+            if stages is not None:
+                if volume_key is None:
+                    volume_key = _volume_key(volume)
+                return stages.tree(volume, volume_key, thresholds), None
+            return ThresholdTree(_enhance_volume(volume), thresholds), None
+    except Exception as e:
+        return None, f"Error building threshold tree: {str(e)}"
+
+def safe_segment_tumor(volume: np.ndarray, threshold: float, min_size: int,
+                       slab_depth: Optional[int] = None, stages: Optional[SegmentationStages] = None,
+                       volume_key: Optional[str] = None, morphology: str = MORPHOLOGY_BACKEND,
+                       workers: int = SEGMENT_WORKERS) -> Tuple[Optional[np.ndarray], Optional[str]]:
+    """Advanced brain tumor segmentation for 3D MRI, returning a boolean mask
+    
+    With `slab_depth` set, the volume is processed out-of-core in slabs of that many
+    planes (see choose_segment_slab_depth) with the same result as the in-memory path.
+    Otherwise `stages` (a SegmentationStages) reuses the intermediate results of earlier
+    calls on the same volume; `volume_key` identifies it and is hashed from the data if omitted.
+    `morphology` selects the binary_morphology backend. With `workers` > 1, in-memory scans
+    of at least PARALLEL_MIN_VOXELS voxels are segmented slab-parallel in that many forked
+    processes; `stages` then only memoizes the final masks.
+    Without fork, with other threads running, or if the workers fail, the scan is segmented
+    serially with the same result.
+    """
+    try:
+        if volume is None or volume.size == 0:
+            return None, "Empty volume data"
+        
         # Validate parameters
         if not 0 <= threshold <= 1:
             return None, "Threshold must be between 0 and 1"
         if min_size < 0:
             return None, "Minimum size must be positive"
+        if morphology not in MORPHOLOGY_BACKENDS:
+            return None, f"Unknown morphology backend: {morphology}"
+        
+        if slab_depth is not None:
+            try:
+                with profile_stage("segment_slabs"):
+                    return _segment_tumor_slabs(volume, threshold, min_size, slab_depth, morphology), None
+            except Exception as e:
+                return None, f"Error in tumor detection: {str(e)}"
+        
+        if workers > 1 and volume.size >= PARALLEL_MIN_VOXELS and _can_fork_workers():
+            try:
+                def compute():
+                    with profile_stage("segment_parallel"):
+                        return _segment_tumor_parallel(volume, threshold, min_size, workers, morphology)
+                if stages is not None:
+                    # The compute callable must come from this call: forked workers
+                    # unpickle functions by name from the current __main__ module
+                    if volume_key is None:
+                        volume_key = _volume_key(volume)
+                    predicted_mask = stages.mask(volume, volume_key, threshold, min_size, morphology, compute=compute)
+                else:
+                    predicted_mask = compute()
+                return predicted_mask, None
+            except Exception:
+                # Workers that fail to start or run; the serial path below gives the same mask
+                pass
         
         try:
-            # 1. Brain-specific preprocessing
-            smoothed = ndimage.gaussian_filter(volume_float, sigma=1.0)
-            
-            # 2. Brain-specific normalization
-            vmin, vmax = np.percentile(smoothed, (1, 99))
-            enhanced = np.clip((smoothed - vmin) / (vmax - vmin), 0, 1)
-            
-            # 3. Brain-specific tumor detection
-            binary = enhanced > threshold
-            
-            # 4. Brain-specific morphological operations
-            kernel = np.ones((3,3,3))
-            binary = ndimage.binary_opening(binary, structure=kernel)
-            binary = ndimage.binary_closing(binary, structure=kernel)
+            if stages is not None:
+                if volume_key is None:
+                    volume_key = _volume_key(volume)
+                predicted_mask = stages.mask(volume, volume_key, threshold, min_size, morphology)
+            else:
+                labeled, _, regions = _label_components(_enhance_volume(volume), threshold, morphology)
+                predicted_mask = _filter_components(labeled, regions, min_size, morphology)
             
-            # 5. Connected component analysis
-            labeled, num_features = ndimage.label(binary)
-            sizes = np.bincount(labeled.ravel())
-            mask_sizes = sizes > min_size
-            mask_sizes[0] = 0  # Remove background
-            
-            # 6. Brain-specific filtering
-            for i in range(1, len(sizes)):
-                if mask_sizes[i]:
-                    region = (labeled == i)
-                    mean_intensity = np.mean(enhanced[region])
-                    region_volume = sizes[i]
-                    region_shape = np.sum(region, axis=(0,1))
-                    
-                    if (mean_intensity < 0.2 or 
-                        mean_intensity > 0.8 or 
-                        region_volume > volume_float.size * 0.3 or 
-                        np.max(region_shape) > volume_float.shape[2] * 0.8):
-                        mask_sizes[i] = False
-            
-            # 7. Create final mask
-            predicted_mask = mask_sizes[labeled]
-            
-            # 8. Final cleanup
-            predicted_mask = ndimage.binary_dilation(predicted_mask, iterations=1)
-            predicted_mask = ndimage.binary_erosion(predicted_mask, iterations=1)
-            
-            return predicted_mask.astype(np.float64), None
+            return predicted_mask, None
             
         except Exception as e:
             return None, f"Error in tumor detection: {str(e)}"
@@ -206,42 +1854,135 @@ def safe_segment_tumor(volume: np.ndarray, threshold: float, min_size: int) -> T
     except Exception as e:
         return None, f"Error in segmentation: {str(e)}"
 
+def _quantize_intensities(values: np.ndarray) -> np.ndarray:
+    """Normalized [0, 1] intensities to uint8"""
+    return np.rint(np.clip(values, 0, 1) * 255).astype(np.uint8)
+
+def _contrast_lut(contrast: float, brightness: float) -> np.ndarray:
+    """256-entry table applying `value * contrast + brightness` (clipped) to uint8 intensities"""
+    return _quantize_intensities(np.arange(256) / 255 * contrast + brightness)
+
+# Color of a masked pixel for each gray level: alpha-blend of gray and the overlay color
+_OVERLAY_LUT = np.rint(np.arange(256)[:, None] * (1 - MASK_OVERLAY_ALPHA)
+                       + np.array(MASK_OVERLAY_COLOR) * MASK_OVERLAY_ALPHA).astype(np.uint8)
+
+def _overlay_mask(gray: np.ndarray, mask_slice: np.ndarray) -> np.ndarray:
+    """RGB image of a uint8 slice with only the mask pixels blended with the overlay color"""
+    if mask_slice.shape != gray.shape:
+        mask_slice = cv2.resize(mask_slice.astype(np.uint8), (gray.shape[1], gray.shape[0]),
+                                interpolation=cv2.INTER_NEAREST)
+    mask_slice = mask_slice.astype(bool, copy=False)
+    colored = cv2.cvtColor(gray, cv2.COLOR_GRAY2RGB)
+    colored[mask_slice] = _OVERLAY_LUT[gray[mask_slice]]
+    return colored
+
 def safe_visualize_slice(slice_img: np.ndarray, mask_slice: Optional[np.ndarray], 
                         contrast: float, brightness: float) -> Tuple[Optional[np.ndarray], Optional[str]]:
     """Safely visualize slice with mask overlay"""
     try:
-        slice_img = (slice_img * contrast) + brightness
-        slice_img = np.clip(slice_img, 0, 1)
-        
+        gray = cv2.LUT(_quantize_intensities(slice_img), _contrast_lut(contrast, brightness))
         if mask_slice is not None:
-            if mask_slice.shape != slice_img.shape:
-                mask_slice = cv2.resize(mask_slice.astype(np.uint8), 
-                                      (slice_img.shape[1], slice_img.shape[0]), 
-                                      interpolation=cv2.INTER_NEAREST)
-            
-            mask_slice = mask_slice.astype(bool)
-            colored_slice = cv2.cvtColor((slice_img * 255).astype(np.uint8), cv2.COLOR_GRAY2RGB)
-            masked_slice = colored_slice.copy()
-            masked_slice[mask_slice] = [255, 0, 0]
-            alpha = 0.7
-            colored_slice = cv2.addWeighted(colored_slice, 1-alpha, masked_slice, alpha, 0)
-            return colored_slice, None
-        else:
-            return (slice_img * 255).astype(np.uint8), None
+            return _overlay_mask(gray, mask_slice), None
+        return gray, None
     except Exception as e:
         return None, f"Error in slice visualization: {str(e)}"
 
-def safe_marching_cubes(data: np.ndarray, level: float) -> Tuple[Optional[Tuple], Optional[str]]:
+class SliceRenderer:
+    """Slice viewer backend: the normalized volume quantized to uint8 once.
+    
+    Each plane is served from its own C-contiguous layout with that plane's axis
+    first, built on first use, so every slice is one contiguous block instead of a
+    strided gather; the mask overlay gets the same per-plane layouts. Contrast and
+    brightness go through a 256-entry lookup table and only mask pixels are blended.
+    Encoded PNGs are kept per (plane, index, contrast, brightness, mask key) in an
+    LRU under `max_bytes`, which makes revisiting slices while scrubbing a
+    dictionary lookup. Keep one instance per scan in st.session_state.
+    """
+    
+    def __init__(self, volume: np.ndarray, volume_key: str, max_bytes: int = SLICE_CACHE_MAX_BYTES):
+        self.volume_key = volume_key
+        self.max_bytes = max_bytes
+        self.shape = tuple(volume.shape)
+        # The C-ordered quantized volume is already the sagittal layout
+        quantized = np.empty(self.shape, dtype=np.uint8)
+        for index in _iter_slabs(self.shape):
+            quantized[index] = _quantize_intensities(np.asarray(volume[index]))
+        self._layouts = {"sagittal": quantized}
+        self._mask = None
+        self._mask_key = None
+        self._mask_layouts = {}
+        self._encoded = OrderedDict()
+        self._nbytes = 0
+    
+    @staticmethod
+    def _plane_layout(source, plane: str) -> np.ndarray:
+        axis = VolumeHandle.PLANE_AXES[plane]
+        array = np.asarray(source)
+        if axis == 2 and array.flags.c_contiguous and array.itemsize == 1:
+            # Axial is a 2D transpose of the (x*y, z) matrix, several times faster in OpenCV
+            flat = cv2.transpose(array.reshape(-1, array.shape[2]).view(np.uint8))
+            return flat.reshape(array.shape[2], array.shape[0], array.shape[1]).view(array.dtype)
+        return np.ascontiguousarray(np.moveaxis(array, axis, 0))
+    
+    def set_mask(self, mask: Optional[np.ndarray], mask_key: Optional[str]):
+        """Overlay source; cached images of other masks age out of the LRU"""
+        if mask is None or mask_key is None:
+            mask, mask_key = None, None
+        if mask_key != self._mask_key:
+            self._mask_layouts = {}
+        self._mask = mask
+        self._mask_key = mask_key
+    
+    def num_slices(self, plane: str = "axial") -> int:
+        return self.shape[VolumeHandle.PLANE_AXES[plane]]
+    
+    def render(self, index: int, contrast: float, brightness: float, show_mask: bool = True,
+               plane: str = "axial") -> np.ndarray:
+        """uint8 grayscale slice, or RGB with the mask overlay"""
+        if not 0 <= index < self.num_slices(plane):
+            raise IndexError(f"{plane} slice {index} out of range (0-{self.num_slices(plane) - 1})")
+        if plane not in self._layouts:
+            self._layouts[plane] = self._plane_layout(self._layouts["sagittal"], plane)
+        gray = cv2.LUT(self._layouts[plane][index], _contrast_lut(contrast, brightness))
+        if show_mask and self._mask is not None:
+            if plane not in self._mask_layouts:
+                self._mask_layouts[plane] = self._plane_layout(self._mask, plane).astype(bool, copy=False)
+            return _overlay_mask(gray, self._mask_layouts[plane][index])
+        return gray
+    
+    def encoded(self, index: int, contrast: float, brightness: float, show_mask: bool = True,
+                plane: str = "axial") -> bytes:
+        """PNG bytes of render(), cached"""
+        key = (plane, index, round(contrast, 6), round(brightness, 6), self._mask_key if show_mask else None)
+        if key in self._encoded:
+            self._encoded.move_to_end(key)
+            return self._encoded[key]
+        
+        image = self.render(index, contrast, brightness, show_mask, plane)
+        if image.ndim == 3:
+            image = cv2.cvtColor(image, cv2.COLOR_RGB2BGR)
+        ok, buffer = cv2.imencode(".png", image, [cv2.IMWRITE_PNG_COMPRESSION, 1])
+        if not ok:
+            raise BrainAnalysisError(f"Could not encode {plane} slice {index}")
+        data = buffer.tobytes()
+        self._encoded[key] = data
+        self._nbytes += len(data)
+        while self._nbytes > self.max_bytes and self._encoded:
+            _, evicted = self._encoded.popitem(last=False)
+            self._nbytes -= len(evicted)
+        return data
+
+def safe_marching_cubes(data: np.ndarray, level: float, step_size: int = 1) -> Tuple[Optional[Tuple], Optional[str]]:
     """Safely perform marching cubes with error handling"""
     try:
         if data is None or data.size == 0:
             return None, "Empty data for marching cubes"
         
-        data = data.astype(np.float64)
+        data = np.asarray(data, dtype=np.float32)
         levels = [level, 0.3, 0.7, 0.1, 0.9]
         for l in levels:
             try:
-                result = measure.marching_cubes(data, level=l)
+                result = measure.marching_cubes(data, level=l, step_size=step_size)
                 return result, None
             except ValueError:
                 continue
@@ -249,11 +1990,151 @@ def safe_marching_cubes(data: np.ndarray, level: float) -> Tuple[Optional[Tuple]
     except Exception as e:
         return None, f"Error in marching cubes: {str(e)}"
 
-def safe_generate_ai_summary(tumor_volume: float, tumor_percentage: float, 
-                           total_volume: float, confidence_score: float) -> Tuple[Optional[str], Optional[str]]:
-    """Safely generate AI summary with error handling"""
+def safe_surface_mesh(data: np.ndarray, level: float,
+                      max_triangles: Optional[int] = MESH_TRIANGLE_BUDGET) -> Tuple[Optional[Tuple[np.ndarray, np.ndarray, int]], Optional[str]]:
+    """Surface with at most `max_triangles` triangles, as (float32 verts, int32 faces, step_size).
+    
+    A pilot pass at a coarse step_size counts triangles; since the count falls at
+    least with the square of the step, that picks the finest step expected to fit,
+    which is then coarsened until the budget holds. max_triangles=None extracts at
+    full resolution.
+    """
+    try:
+        if data is None or data.size == 0:
+            return None, "Empty data for marching cubes"
+        
+        with profile_stage("marching_cubes"):
+            step = 1
+            if max_triangles is not None and data.size > MESH_PILOT_VOXELS:
+                pilot = max(2, int(round((data.size / MESH_PILOT_VOXELS) ** (1 / 3))))
+                result, error = safe_marching_cubes(data, level, pilot)
+                if error:
+                    return None, error
+                step = max(1, int(np.ceil(pilot * np.sqrt(len(result[1]) / max(max_triangles, 1)))))
+        
+            surface = None
+            while True:
+                result, error = safe_marching_cubes(data, level, step)
+                if error:
+                    # Too coarse for this data; keep the last surface that worked
+                    if surface is None:
+                        return None, error
+                    break
+                surface = (result[0], result[1], step)
+                if max_triangles is None or len(result[1]) <= max_triangles or step >= max(data.shape):
+                    break
+                step += 1
+            verts, faces, step = surface
+            return (verts.astype(np.float32, copy=False), faces.astype(np.int32, copy=False), step), None
+    except Exception as e:
+        return None, f"Error in surface extraction: {str(e)}"
+
+def safe_mask_surface(mask: np.ndarray, level: float = 0.5, max_triangles: Optional[int] = MESH_TRIANGLE_BUDGET,
+                      bboxes: Optional[np.ndarray] = None) -> Tuple[Optional[Tuple[np.ndarray, np.ndarray, int]], Optional[str]]:
+    """Surface of a binary mask extracted only around its foreground, in volume coordinates.
+    
+    `bboxes` (N, 3, 2), e.g. RegionStats.bboxes, are padded by one voxel so every
+    surface closes as it would in the full volume; overlapping boxes are merged.
+    Without boxes the foreground bounding box is found slab by slab. Each box runs
+    safe_surface_mesh on its crop with a share of the budget proportional to its
+    size, so the cost follows the tumor instead of the scan. Returns the coarsest
+    step_size used.
+    """
     try:
-        prompt = f"""
+        if mask is None or mask.size == 0:
+            return None, "Empty data for marching cubes"
+        
+        shape = np.array(mask.shape)
+        if bboxes is None:
+            occupied = [np.zeros(size, dtype=bool) for size in mask.shape]
+            for index in _iter_slabs(mask.shape):
+                block = np.asarray(mask[index]).astype(bool, copy=False)
+                for axis in range(mask.ndim):
+                    occupied[axis][index[axis]] |= block.any(axis=tuple(a for a in range(mask.ndim) if a != axis))
+            if not occupied[0].any():
+                return None, "Could not generate surface with any level"
+            bboxes = np.array([[[np.argmax(o), o.size - np.argmax(o[::-1])] for o in occupied]])
+        if len(bboxes) == 0:
+            return None, "Could not generate surface with any level"
+        
+        # Pad, clip to the volume and merge boxes until none overlap
+        boxes = [np.stack([np.maximum(b[:, 0] - 1, 0), np.minimum(b[:, 1] + 1, shape)], axis=1) for b in np.asarray(bboxes)]
+        merged = True
+        while merged:
+            merged = False
+            for i in range(len(boxes)):
+                for j in range(i + 1, len(boxes)):
+                    if np.all(boxes[i][:, 0] < boxes[j][:, 1]) and np.all(boxes[j][:, 0] < boxes[i][:, 1]):
+                        boxes[i] = np.stack([np.minimum(boxes[i][:, 0], boxes[j][:, 0]),
+                                             np.maximum(boxes[i][:, 1], boxes[j][:, 1])], axis=1)
+                        del boxes[j]
+                        merged = True
+                        break
+                if merged:
+                    break
+        
+        sizes = np.array([np.prod(box[:, 1] - box[:, 0]) for box in boxes], dtype=np.float64)
+        all_verts, all_faces, step, offset = [], [], 1, 0
+        for box, size in zip(boxes, sizes):
+            crop = np.asarray(mask[tuple(slice(start, stop) for start, stop in box)])
+            budget = None if max_triangles is None else max(1, int(max_triangles * size / sizes.sum()))
+            result, error = safe_surface_mesh(crop, level, budget)
+            if error:
+                continue
+            verts, faces, box_step = result
+            all_verts.append(verts + box[:, 0].astype(np.float32))
+            all_faces.append(faces + offset)
+            offset += len(verts)
+            step = max(step, box_step)
+        if not all_verts:
+            return None, "Could not generate surface with any level"
+        return (np.concatenate(all_verts), np.concatenate(all_faces).astype(np.int32, copy=False), step), None
+    except Exception as e:
+        return None, f"Error in surface extraction: {str(e)}"
+
+class MeshCache:
+    """LRU cache of extracted surfaces under a byte budget.
+    
+    Entries are keyed by (volume key, mask key, level, max_triangles), with mask key
+    None for the brain surface, and hold the vertices and faces the 3D view draws.
+    Keep one instance per user session so style-only reruns skip skimage entirely.
+    """
+    
+    def __init__(self, max_bytes: int = MESH_CACHE_MAX_BYTES):
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()
+        self._nbytes = 0
+    
+    @staticmethod
+    def _size(mesh: tuple) -> int:
+        return sum(part.nbytes for part in mesh if isinstance(part, np.ndarray))
+    
+    def surface(self, key: tuple, compute) -> Tuple[Optional[tuple], Optional[str]]:
+        """Cached result of `compute()`, a safe_surface_mesh-style (mesh, error) call; errors are not kept"""
+        if key in self._entries:
+            self._entries.move_to_end(key)
+            return self._entries[key], None
+        
+        mesh, error = compute()
+        if error:
+            return None, error
+        size = self._size(mesh)
+        # A surface larger than the whole budget is returned but not kept
+        if size <= self.max_bytes:
+            self._entries[key] = mesh
+            self._nbytes += size
+            while self._nbytes > self.max_bytes:
+                _, evicted = self._entries.popitem(last=False)
+                self._nbytes -= self._size(evicted)
+        return mesh, None
+    
+    def __contains__(self, key: tuple) -> bool:
+        return key in self._entries
+
+def _summary_prompt(tumor_volume: float, tumor_percentage: float,
+                    total_volume: float, confidence_score: float) -> str:
+    """Gemini prompt for the summary; statistics appear at display precision"""
+    return f"""
         Based on the following brain MRI analysis results, provide a concise medical summary:
         - Tumor Volume: {tumor_volume:,.0f} voxels
         - Tumor Percentage: {tumor_percentage:.2f}%
@@ -266,6 +2147,62 @@ def safe_generate_ai_summary(tumor_volume: float, tumor_percentage: float,
         3. Recommended next steps
         Keep the response professional and medical-focused.
         """
+
+class SummaryCache:
+    """Persistent cache of AI summaries in SQLite, keyed by model and prompt.
+    
+    The prompt holds the statistics rounded to display precision, so reruns and
+    other sessions whose results read the same share one entry. Entries expire
+    after `ttl` seconds. Each call opens its own connection, which keeps the cache
+    safe to share between Streamlit's session threads; database errors count as
+    misses so a broken cache never blocks a summary.
+    """
+    
+    def __init__(self, path: str = SUMMARY_CACHE_PATH, ttl: float = SUMMARY_CACHE_TTL_SECONDS):
+        self.path = path
+        self.ttl = ttl
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._execute("CREATE TABLE IF NOT EXISTS summaries "
+                      "(key TEXT PRIMARY KEY, summary TEXT NOT NULL, created REAL NOT NULL)")
+    
+    @staticmethod
+    def key_for_prompt(prompt: str, model_name: str = GEMINI_MODEL) -> str:
+        return hashlib.sha256(f"{model_name}\n{prompt}".encode()).hexdigest()
+    
+    def _execute(self, sql: str, params: tuple = ()) -> Optional[list]:
+        try:
+            conn = sqlite3.connect(self.path, timeout=10)
+            try:
+                with conn:
+                    return conn.execute(sql, params).fetchall()
+            finally:
+                conn.close()
+        except sqlite3.Error:
+            return None
+    
+    def get(self, key: str) -> Optional[str]:
+        rows = self._execute("SELECT summary FROM summaries WHERE key = ? AND created >= ?",
+                             (key, time.time() - self.ttl))
+        return rows[0][0] if rows else None
+    
+    def put(self, key: str, summary: str):
+        now = time.time()
+        self._execute("INSERT OR REPLACE INTO summaries (key, summary, created) VALUES (?, ?, ?)", (key, summary, now))
+        self._execute("DELETE FROM summaries WHERE created < ?", (now - self.ttl,))
+
+def safe_generate_ai_summary(tumor_volume: float, tumor_percentage: float, 
+                           total_volume: float, confidence_score: float,
+                           cache: Optional[SummaryCache] = None) -> Tuple[Optional[str], Optional[str]]:
+    """Safely generate AI summary with error handling; `cache` skips Gemini for prompts seen before"""
+    try:
+        prompt = _summary_prompt(tumor_volume, tumor_percentage, total_volume, confidence_score)
+        key = SummaryCache.key_for_prompt(prompt) if cache is not None else None
+        if key is not None:
+            summary = cache.get(key)
+            if summary is not None:
+                return summary, None
         
         generation_config = {
             "temperature": 0.7,
@@ -275,13 +2212,16 @@ def safe_generate_ai_summary(tumor_volume: float, tumor_percentage: float,
         }
         
         response = model.generate_content(prompt, generation_config=generation_config)
+        if key is not None:
+            cache.put(key, response.text)
         return response.text, None
     except Exception as e:
         return None, f"Error generating AI summary: {str(e)}"
 
 # Configure Gemini API
 genai.configure(api_key=st.secrets["GEMINI_API_KEY"])
-model = genai.GenerativeModel('gemini-2.0-flash')
+model = genai.GenerativeModel(GEMINI_MODEL)
+summary_cache = SummaryCache()
 
 # Set page config for better mobile experience
 st.set_page_config(
@@ -427,8 +2367,8 @@ with st.sidebar:
     st.markdown("---")
     st.markdown("#### 📤 Upload MRI")
     uploaded_file = st.file_uploader(
-        "Select Brain MRI (.nii.gz or .zip)",
-        type=["nii.gz", "zip"],
+        "Select Brain MRI (.nii.gz, .nii or .zip)",
+        type=["nii.gz", "nii", "zip"],
         help="Upload your brain MRI scan for analysis",
         key="file_uploader"
     )
@@ -449,6 +2389,16 @@ with st.sidebar:
         step=10,
         help="Minimum size of tumor regions (voxels). Recommended: 100-200"
     )
+    precompute_sweep = st.checkbox(
+        "Precompute Sensitivity Sweep",
+        value=False,
+        help="Builds a component tree once so every sensitivity step is a fast lookup, and plots tumor volume against sensitivity"
+    )
+    apply_clahe = st.checkbox(
+        "Contrast Enhancement (CLAHE)",
+        value=False,
+        help="Equalizes local contrast slice by slice before detection"
+    )
     st.markdown("#### 📊 Results")
     col1, col2 = st.columns(2)
     with col1:
@@ -456,6 +2406,7 @@ with st.sidebar:
         tumor_percentage_placeholder = st.empty()
     with col2:
         confidence_score_placeholder = st.empty()
+    profile_placeholder = st.empty()
 
 # Updated Back to Home button with new URL
 st.markdown("""
@@ -471,46 +2422,253 @@ st.markdown("""
     ">Back to Home</a>
 """, unsafe_allow_html=True)
 
+def _mesh_trace(mesh: tuple, color: str, opacity: float, name: str) -> go.Mesh3d:
+    """Mesh3d from (verts, faces, ...), with one contiguous float32 / uint32 array per coordinate
+    so Plotly ships them as base64 typed arrays instead of JSON number lists"""
+    verts = np.ascontiguousarray(mesh[0].T, dtype=np.float32)
+    faces = np.ascontiguousarray(mesh[1].T, dtype=np.uint32)
+    return go.Mesh3d(
+        x=verts[0], y=verts[1], z=verts[2],
+        i=faces[0], j=faces[1], k=faces[2],
+        color=color, opacity=opacity, name=name,
+        showscale=False
+    )
+
+def _style_controls(trace: int, label: str, colors: dict, opacity: float, menu_x: float,
+                    slider_x: float) -> Tuple[dict, dict]:
+    """Color menu and opacity slider restyling one trace in the browser"""
+    menu = dict(
+        buttons=[dict(label=name, method="restyle", args=[{"color": color}, [trace]]) for name, color in colors.items()],
+        direction="down", showactive=True, x=menu_x, xanchor="left", y=1.0, yanchor="top"
+    )
+    steps = [dict(label=f"{value:.1f}", method="restyle", args=[{"opacity": value}, [trace]])
+             for value in np.round(np.arange(11) / 10, 1)]
+    slider = dict(
+        steps=steps, active=int(round(opacity * 10)), x=slider_x, len=0.45, y=0, yanchor="top",
+        currentvalue=dict(prefix=f"{label} opacity: "), pad=dict(t=10)
+    )
+    return menu, slider
+
+def build_mesh_figure(brain_mesh: tuple, tumor_mesh: Optional[tuple], uirevision: str = 'constant') -> go.Figure:
+    """3D view figure from (verts, faces, ...) surfaces; tumor_mesh may be None.
+    
+    Color presets, opacity, axes and legend are Plotly menus and sliders that patch
+    the figure in the browser; the page's own color and opacity widgets are applied
+    to the built figure with style_mesh_figure.
+    Figures with the same `uirevision` keep the user's camera when they replace
+    each other.
+    """
+    fig = go.Figure()
+    fig.add_trace(_mesh_trace(brain_mesh, next(iter(BRAIN_COLORS.values())), BRAIN_OPACITY, "Brain"))
+    menus, sliders = [], []
+    menu, slider = _style_controls(0, "Brain", BRAIN_COLORS, BRAIN_OPACITY, 0.0, 0.0)
+    menus.append(menu)
+    sliders.append(slider)
+
+    if tumor_mesh is not None:
+        fig.add_trace(_mesh_trace(tumor_mesh, next(iter(TUMOR_COLORS.values())), TUMOR_OPACITY, "Predicted Tumor"))
+        menu, slider = _style_controls(1, "Tumor", TUMOR_COLORS, TUMOR_OPACITY, 0.2, 0.55)
+        menus.append(menu)
+        sliders.append(slider)
+
+    axes_hidden = {f"scene.{axis}.visible": False for axis in ("xaxis", "yaxis", "zaxis")}
+    axes_shown = {f"scene.{axis}.visible": True for axis in ("xaxis", "yaxis", "zaxis")}
+    menus.append(dict(
+        type="buttons", direction="right", showactive=False, x=1.0, xanchor="right", y=1.0, yanchor="top",
+        buttons=[
+            dict(label="Axes", method="relayout", args=[axes_hidden], args2=[axes_shown]),
+            dict(label="Legend", method="relayout", args=[{"showlegend": False}], args2=[{"showlegend": True}])
+        ]
+    ))
+
+    fig.update_layout(
+        scene=dict(
+            xaxis_title='Right-Left',
+            yaxis_title='Anterior-Posterior',
+            zaxis_title='Superior-Inferior',
+            aspectmode='data',
+            camera=dict(
+                up=dict(x=0, y=0, z=1),
+                center=dict(x=0, y=0, z=0),
+                eye=dict(x=1.5, y=1.5, z=1.5)
+            )
+        ),
+        margin=dict(l=0, r=0, b=60, t=40),
+        showlegend=True,
+        height=560,
+        width=None,
+        scene_aspectmode='data',
+        dragmode='orbit',
+        hovermode='closest',
+        uirevision=uirevision,
+        updatemenus=menus,
+        sliders=sliders
+    )
+
+    fig.update_scenes(
+        xaxis=dict(title=dict(text="Right-Left"), showgrid=True, zeroline=True),
+        yaxis=dict(title=dict(text="Anterior-Posterior"), showgrid=True, zeroline=True),
+        zaxis=dict(title=dict(text="Superior-Inferior"), showgrid=True, zeroline=True)
+    )
+    return fig
+
+def style_mesh_figure(fig: go.Figure, brain_style: Tuple[str, float], tumor_style: Tuple[str, float]) -> go.Figure:
+    """Apply (color, opacity) from the page widgets to a build_mesh_figure figure in place.
+    
+    Only trace styles and the active state of the on-chart presets change, so a cached
+    figure can be restyled on every rerun without rebuilding its meshes.
+    """
+    for trace, (color, opacity) in enumerate((brain_style, tumor_style)[:len(fig.data)]):
+        fig.data[trace].update(color=color, opacity=opacity)
+        # Highlight the matching preset, or none for a custom color
+        presets = [button.args[0]["color"].lower() for button in fig.layout.updatemenus[trace].buttons]
+        fig.layout.updatemenus[trace].active = presets.index(color.lower()) if color.lower() in presets else -1
+        fig.layout.sliders[trace].active = int(round(opacity * 10))
+    return fig
+
+# Slice viewer runs as a fragment: scrolling reruns only this function and renders
+# a single slice from the session's SliceRenderer instead of re-running the whole analysis
+@st.fragment
+def render_slices_tab(renderer: SliceRenderer):
+    st.subheader("📊 Slices")
+    try:
+        col1, col2, col3 = st.columns(3)
+        with col1:
+            contrast = st.slider("Contrast", 0.0, 2.0, 1.0, 0.1)
+        with col2:
+            brightness = st.slider("Brightness", -1.0, 1.0, 0.0, 0.1)
+        with col3:
+            show_mask = st.checkbox("Show Tumor Mask", value=True)
+
+        for column, plane in zip(st.columns(3), ("axial", "coronal", "sagittal")):
+            with column:
+                max_slice_idx = renderer.num_slices(plane) - 1
+                slice_idx = st.slider(f"{plane.capitalize()} Slice", 0, max_slice_idx,
+                                      min((max_slice_idx + 1) // 2, max_slice_idx))
+                st.image(renderer.encoded(slice_idx, contrast, brightness, show_mask, plane),
+                         caption=f"{plane.capitalize()} slice {slice_idx}", use_container_width=True)
+    except Exception as e:
+        st.error(f"Error in slice analysis: {str(e)}")
+
+def show_pipeline_profile(placeholder, profiler: PipelineProfiler):
+    """Collapsible table of the stages measured on this run, nested stages indented"""
+    if not profiler.records:
+        return
+    with placeholder.container():
+        with st.expander("⏱️ Pipeline Profile"):
+            st.dataframe([
+                {
+                    "Stage": "\u2003" * record.depth + record.stage,
+                    "Wall (s)": round(record.wall_seconds, 3),
+                    "CPU (s)": round(record.cpu_seconds, 3),
+                    "Process Peak (MB)": None if record.process_peak_bytes is None else round(record.process_peak_bytes / 2**20, 1),
+                }
+                for record in profiler.records
+            ], hide_index=True, use_container_width=True)
+            st.caption("Stages served from a cache on this rerun are not listed. "
+                       "CPU time and peak memory are process-wide; the peak is left empty "
+                       "for stages that overlapped another session's run.")
+
+# Polled only while a background surface extraction is pending; a full run of the page
+# stops the polling, and the rerun triggered here draws the final surfaces from the cache
+@st.fragment(run_every=MESH_REFINE_POLL_SECONDS)
+def await_mesh_refinement(future):
+    if future.done():
+        st.rerun()
+    st.caption("⏳ Refining surfaces in the background...")
+
 # Main content
 if uploaded_file:
-    with tempfile.TemporaryDirectory() as temp_dir:
+    # Stages of this run, recorded by profile_stage() calls in the pipeline functions
+    profiler = PipelineProfiler()
+    
+    def stop_run():
+        """st.stop() for a failed run, showing the stages measured so far first
+        (no element can be drawn once the stop has been requested)"""
+        show_pipeline_profile(profile_placeholder, profiler)
+        st.stop()
+    
+    with tempfile.TemporaryDirectory() as temp_dir, profiler.activate():
         try:
             with st.spinner("Processing MRI..."):
-                file_path = os.path.join(temp_dir, uploaded_file.name)
-                with open(file_path, "wb") as f:
-                    f.write(uploaded_file.getbuffer())
-                
-                volume, error = safe_load_volume(file_path)
-                if error:
-                    st.error(f"Error loading MRI: {error}")
-                    st.stop()
+                # Keep the on-disk dtype; normalization produces the float volume
+                dtype_policy = "native"
                 
-                volume, error = safe_normalize_volume(volume)
-                if error:
-                    st.error(f"Error processing MRI: {error}")
-                    st.stop()
+                # Reruns on the same scan reuse the cached normalized volume without touching the upload
+                volume_cache = VolumeCache()
+                if st.session_state.get('volume_key_file_id') != uploaded_file.file_id:
+                    st.session_state['volume_key'] = VolumeCache.key_for_bytes(uploaded_file.getbuffer(), dtype_policy)
+                    st.session_state['volume_key_file_id'] = uploaded_file.file_id
+                    # Intermediate results of the previous scan are no longer reachable
+                    st.session_state.pop('segmentation_stages', None)
+                    st.session_state.pop('clahe_volume', None)
+                volume_key = st.session_state['volume_key']
+                with profile_stage("volume_cache_read"):
+                    volume = volume_cache.get(volume_key)
+                if volume is None:
+                    file_path = os.path.join(temp_dir, uploaded_file.name)
+                    with open(file_path, "wb") as f:
+                        f.write(uploaded_file.getbuffer())
+                    
+                    volume, error = safe_load_normalized_volume(
+                        file_path, dtype_policy=dtype_policy, cache=volume_cache, cache_key=volume_key
+                    )
+                    if error:
+                        st.error(f"Error loading MRI: {error}")
+                        stop_run()
                 
                 st.success("✅ MRI loaded successfully")
                 
-                predicted_mask, error = safe_segment_tumor(volume, threshold, min_size)
+                # Detection optionally runs on a CLAHE-enhanced copy; stats and views keep the original
+                detection_volume, detection_key = volume, volume_key
+                if apply_clahe:
+                    clahe_cache = st.session_state.get('clahe_volume')
+                    if clahe_cache is None or clahe_cache[0] != volume_key:
+                        enhanced_volume, error = safe_clahe_volume(volume)
+                        if error:
+                            st.error(f"Error in contrast enhancement: {error}")
+                            stop_run()
+                        clahe_cache = (volume_key, enhanced_volume)
+                        st.session_state['clahe_volume'] = clahe_cache
+                    detection_volume, detection_key = clahe_cache[1], volume_key + "-clahe"
+                
+                # Scans too large for the memory budget are segmented out-of-core
+                segment_slab_depth = choose_segment_slab_depth(volume)
+                # Threshold / min-size changes reuse the earlier stages of this scan
+                stages = st.session_state.setdefault('segmentation_stages', SegmentationStages())
+                threshold_tree = None
+                if precompute_sweep and segment_slab_depth is None:
+                    threshold_tree, error = safe_threshold_tree(detection_volume, stages, detection_key)
+                    if error:
+                        st.error(f"Error in tumor detection: {error}")
+                        stop_run()
+                with profile_stage("segmentation"):
+                    predicted_mask, error = safe_segment_tumor(
+                        detection_volume, threshold, min_size, slab_depth=segment_slab_depth,
+                        stages=stages, volume_key=detection_key,
+                        # Parallel segmentation is CLI-only. Forking the multithreaded Streamlit server
+                        # can deadlock the workers, and spawn/forkserver workers would re-import this
+                        # page as __main__ and re-run it in every worker
+                        workers=1
+                    )
                 if error:
                     st.error(f"Error in tumor detection: {error}")
-                    st.stop()
-            
-            st.session_state['predicted_mask'] = predicted_mask
+                    stop_run()
+                
+                # One labeling pass over the final mask feeds the sidebar, Details tab and summary
+                region_stats, error = safe_region_stats(predicted_mask, volume, slab_depth=segment_slab_depth)
+                if error:
+                    st.error(f"Error in tumor detection: {error}")
+                    stop_run()
             
-            tumor_volume = np.sum(predicted_mask)
-            total_volume = volume.shape[0] * volume.shape[1] * volume.shape[2]
-            tumor_percentage = (tumor_volume / total_volume) * 100 if total_volume > 0 else 0
+            # Kept run-length encoded: kilobytes instead of a full-size array per session
+            st.session_state['predicted_mask'] = CompactMask.from_mask(predicted_mask)
             
-            tumor_size = None
-            tumor_center = None
-            if tumor_volume > 0:
-                tumor_mask_bool = predicted_mask.astype(bool)
-                tumor_coords = np.where(tumor_mask_bool)
-                if tumor_coords[0].size > 0:
-                    tumor_size = [np.max(coord) - np.min(coord) + 1 for coord in tumor_coords]
-                    tumor_center = [np.mean(coord) for coord in tumor_coords]
+            tumor_volume = region_stats.tumor_volume
+            total_volume = region_stats.total_voxels
+            tumor_percentage = region_stats.tumor_percentage
+            tumor_size = region_stats.extent
+            tumor_center = region_stats.center
             
             tumor_volume_placeholder.metric(
                 "Tumor Volume",
@@ -533,9 +2691,25 @@ if uploaded_file:
                 'tumor_percentage': tumor_percentage,
                 'total_volume': total_volume,
                 'tumor_size': tumor_size,
-                'tumor_center': tumor_center
+                'tumor_center': tumor_center,
+                'region_stats': region_stats
             })
             
+            # The summary is network-bound: start it now so it overlaps mesh and slice building.
+            # shutdown(wait=False) lets the single worker finish this call and exit
+            summary_executor = ThreadPoolExecutor(max_workers=1)
+            summary_future = summary_executor.submit(
+                safe_generate_ai_summary, tumor_volume, tumor_percentage, total_volume,
+                (1 - threshold) * 100, cache=summary_cache
+            )
+            summary_executor.shutdown(wait=False)
+            
+            # Identifies the mask for the mesh and slice caches by the inputs that determine it, instead of
+            # hashing the mask on every rerun; None when nothing was detected
+            mask_key = None
+            if predicted_mask is not None and region_stats.num_components:
+                mask_key = f"{detection_key}:{threshold}:{min_size}"
+            
             tab1, tab2, tab3, tab4 = st.tabs([
                 "🧊 3D View",
                 "📊 Slices",
@@ -549,145 +2723,154 @@ if uploaded_file:
                     with st.container():
                         col1, col2, col3 = st.columns(3)
                         with col1:
-                            brain_opacity = st.slider("Brain Opacity", 0.0, 1.0, 0.2, 0.1)
-                            brain_color = st.color_picker("Brain Color", "#ADD8E6")
+                            brain_opacity = st.slider("Brain Opacity", 0.0, 1.0, BRAIN_OPACITY, 0.1)
+                            brain_color = st.color_picker("Brain Color", next(iter(BRAIN_COLORS.values())))
                         with col2:
-                            tumor_opacity = st.slider("Tumor Opacity", 0.0, 1.0, 0.6, 0.1)
-                            tumor_color = st.color_picker("Tumor Color", "#FF0000")
+                            tumor_opacity = st.slider("Tumor Opacity", 0.0, 1.0, TUMOR_OPACITY, 0.1)
+                            tumor_color = st.color_picker("Tumor Color", next(iter(TUMOR_COLORS.values())))
                         with col3:
-                            show_axes = st.checkbox("Show Axes", value=True)
-                            show_legend = st.checkbox("Show Legend", value=True)
+                            full_quality = st.checkbox(
+                                "Full-Quality Surfaces", value=False,
+                                help=f"Extract every voxel instead of about {MESH_TRIANGLE_BUDGET:,} triangles per surface (slow on large scans)"
+                            )
+                            progressive = st.checkbox(
+                                "Progressive Rendering", value=True,
+                                help="Show a coarse surface at once and extract the full one in the background, swapping it in when ready"
+                            )
+                        st.caption("Color presets, axes and legend can also be switched on the chart itself")
+                        max_triangles = None if full_quality else MESH_TRIANGLE_BUDGET
 
-                        brain_result, error = safe_marching_cubes(volume, 0.5)
-                        if error:
-                            st.error(error)
-                            st.stop()
+                        # Geometry depends only on the data and is kept across reruns
+                        mesh_cache = st.session_state.setdefault('mesh_cache', MeshCache())
                         
-                        verts, faces, _, _ = brain_result
+                        brain_key = (volume_key, None, 0.5, max_triangles)
+                        tumor_key = (volume_key, mask_key, 0.5, max_triangles) if mask_key is not None else None
+                        final_keys = (brain_key, tumor_key)
                         
-                        fig = go.Figure()
-                        fig.add_trace(go.Mesh3d(
-                            x=verts[:, 0], y=verts[:, 1], z=verts[:, 2],
-                            i=faces[:, 0], j=faces[:, 1], k=faces[:, 2],
-                            color=brain_color, opacity=brain_opacity, name="Brain",
-                            showscale=False
-                        ))
-
-                        if predicted_mask is not None and np.any(predicted_mask):
-                            tumor_result, error = safe_marching_cubes(predicted_mask, 0.5)
-                            if not error:
-                                tumor_verts, tumor_faces, _, _ = tumor_result
-                                fig.add_trace(go.Mesh3d(
-                                    x=tumor_verts[:, 0], y=tumor_verts[:, 1], z=tumor_verts[:, 2],
-                                    i=tumor_faces[:, 0], j=tumor_faces[:, 1], k=tumor_faces[:, 2],
-                                    color=tumor_color, opacity=tumor_opacity, name="Predicted Tumor",
-                                    showscale=False
-                                ))
-
-                        fig.update_layout(
-                            scene=dict(
-                                xaxis_title='Right-Left',
-                                yaxis_title='Anterior-Posterior',
-                                zaxis_title='Superior-Inferior',
-                                aspectmode='data',
-                                camera=dict(
-                                    up=dict(x=0, y=0, z=1),
-                                    center=dict(x=0, y=0, z=0),
-                                    eye=dict(x=1.5, y=1.5, z=1.5)
+                        # Surfaces extracted in the background since the last run join the cache
+                        refinement = st.session_state.get('mesh_refinement')
+                        if refinement is not None and refinement[1].done():
+                            del st.session_state['mesh_refinement']
+                            for key, (mesh, error) in refinement[1].result():
+                                if not error:
+                                    mesh_cache.surface(key, lambda: (mesh, None))
+                            if any(key is not None and key not in mesh_cache for key in refinement[0]):
+                                # Extract these in the foreground next time so the error is shown
+                                st.session_state['mesh_refinement_failed'] = refinement[0]
+                            refinement = None
+                        
+                        # Progressive rendering draws a preview now and leaves the final surfaces to a
+                        # background thread, so the other tabs don't wait for them; a cached final
+                        # level is drawn directly
+                        missing = [key for key in final_keys if key is not None and key not in mesh_cache]
+                        refine = (progressive and missing
+                                  and (max_triangles is None or MESH_PREVIEW_TRIANGLES < max_triangles)
+                                  and st.session_state.get('mesh_refinement_failed') != final_keys)
+                        
+                        chart = st.empty()
+                        for level_triangles in [MESH_PREVIEW_TRIANGLES if refine else max_triangles]:
+                            with profile_stage("brain_surface"):
+                                brain_result, error = mesh_cache.surface(
+                                    (volume_key, None, 0.5, level_triangles),
+                                    lambda: safe_surface_mesh(volume, 0.5, level_triangles)
                                 )
-                            ),
-                            margin=dict(l=0, r=0, b=0, t=0),
-                            showlegend=show_legend,
-                            height=500,
-                            width=None,
-                            scene_aspectmode='data',
-                            dragmode='orbit',
-                            hovermode='closest',
-                            uirevision='constant'
-                        )
-
-                        fig.update_scenes(
-                            xaxis_visible=show_axes,
-                            yaxis_visible=show_axes,
-                            zaxis_visible=show_axes,
-                            xaxis=dict(title=dict(text="Right-Left"), showgrid=True, zeroline=True),
-                            yaxis=dict(title=dict(text="Anterior-Posterior"), showgrid=True, zeroline=True),
-                            zaxis=dict(title=dict(text="Superior-Inferior"), showgrid=True, zeroline=True)
-                        )
-
-                        st.plotly_chart(fig, use_container_width=True, config={
-                            'displayModeBar': True,
-                            'scrollZoom': True,
-                            'displaylogo': False,
-                            'modeBarButtonsToAdd': ['orbitRotation', 'resetCamera'],
-                            'modeBarButtonsToRemove': ['lasso2d', 'select2d']
-                        })
+                            if error:
+                                st.error(error)
+                                stop_run()
+                            
+                            tumor_result = None
+                            if mask_key is not None:
+                                # Extracted around the detected regions only
+                                with profile_stage("tumor_surface"):
+                                    tumor_result, error = mesh_cache.surface(
+                                        (volume_key, mask_key, 0.5, level_triangles),
+                                        lambda: safe_mask_surface(predicted_mask, 0.5, level_triangles, region_stats.bboxes)
+                                    )
+                            
+                            with profile_stage("figure_serialization"):
+                                # The figure is rebuilt only when the surfaces change; style widgets
+                                # just restyle the cached one
+                                figure_key = ((volume_key, None, 0.5, level_triangles),
+                                              (volume_key, mask_key, 0.5, level_triangles) if tumor_result is not None else None)
+                                cached_figure = st.session_state.get('mesh_figure')
+                                if cached_figure is None or cached_figure[0] != figure_key:
+                                    cached_figure = (figure_key, build_mesh_figure(brain_result, tumor_result, uirevision=volume_key))
+                                    st.session_state['mesh_figure'] = cached_figure
+                                fig = style_mesh_figure(cached_figure[1], (brain_color, brain_opacity),
+                                                        (tumor_color, tumor_opacity))
+                                chart.plotly_chart(fig, use_container_width=True, config={
+                                    'displayModeBar': True,
+                                    'scrollZoom': True,
+                                    'displaylogo': False,
+                                    'modeBarButtonsToAdd': ['orbitRotation', 'resetCamera'],
+                                    'modeBarButtonsToRemove': ['lasso2d', 'select2d']
+                                })
+                        
+                        if refine:
+                            if refinement is None or refinement[0] != final_keys:
+                                extract = {
+                                    brain_key: lambda: safe_surface_mesh(volume, 0.5, max_triangles),
+                                    tumor_key: lambda: safe_mask_surface(predicted_mask, 0.5, max_triangles, region_stats.bboxes),
+                                }
+                                # MeshCache is only touched from the script thread, when the results are collected
+                                refine_executor = ThreadPoolExecutor(max_workers=1)
+                                refinement = (final_keys, refine_executor.submit(
+                                    lambda: [(key, extract[key]()) for key in missing]
+                                ))
+                                refine_executor.shutdown(wait=False)
+                                st.session_state['mesh_refinement'] = refinement
+                            await_mesh_refinement(refinement[1])
                 except Exception as e:
                     st.error(f"Error in 3D visualization: {str(e)}")
                     st.info("Try adjusting the visualization parameters.")
             
             with tab2:
-                st.subheader("📊 Slices")
-                try:
-                    col1, col2 = st.columns(2)
-                    with col1:
-                        max_slice_idx = volume.shape[2] - 1
-                        slice_idx = st.slider("Slice Index", 0, max_slice_idx, min(volume.shape[2] // 2, max_slice_idx))
-                        contrast = st.slider("Contrast", 0.0, 2.0, 1.0, 0.1)
-                    with col2:
-                        brightness = st.slider("Brightness", -1.0, 1.0, 0.0, 0.1)
-                        show_mask = st.checkbox("Show Tumor Mask", value=True)
-
-                    slice_img = volume[:, :, slice_idx]
-                    mask_slice = predicted_mask[:, :, slice_idx] if predicted_mask is not None else None
-                    
-                    result, error = safe_visualize_slice(slice_img, mask_slice, contrast, brightness)
-                    if error:
-                        st.error(error)
-                    else:
-                        st.image(result, caption=f"Slice {slice_idx}")
-                except Exception as e:
-                    st.error(f"Error in slice analysis: {str(e)}")
+                # The quantized volume is built once per scan; a new mask only swaps the overlay
+                with profile_stage("slices"):
+                    renderer = st.session_state.get('slice_renderer')
+                    if renderer is None or renderer.volume_key != volume_key:
+                        renderer = SliceRenderer(volume, volume_key)
+                        st.session_state['slice_renderer'] = renderer
+                    renderer.set_mask(predicted_mask, mask_key)
+                    render_slices_tab(renderer)
             
             with tab3:
                 st.subheader("🔍 Details")
                 if 'tumor_volume' in st.session_state and predicted_mask is not None:
                     st.write("Tumor Statistics")
-                    tumor_mask_bool = predicted_mask.astype(bool)
                     try:
-                        num_regions = len(np.unique(predicted_mask)) - 1
-                        if num_regions < 0:
-                            num_regions = 0
-                        
-                        if np.any(tumor_mask_bool):
-                            avg_intensity = np.mean(volume[tumor_mask_bool])
-                            max_intensity = np.max(volume[tumor_mask_bool])
-                        else:
-                            avg_intensity = 0
-                            max_intensity = 0
-                        
-                        st.write(f"- Number of tumor regions: {num_regions}")
-                        st.write(f"- Average tumor intensity: {avg_intensity:.3f}")
-                        st.write(f"- Maximum tumor intensity: {max_intensity:.3f}")
+                        st.write(f"- Number of tumor regions: {region_stats.num_components}")
+                        st.write(f"- Average tumor intensity: {region_stats.mean_intensity:.3f}")
+                        st.write(f"- Maximum tumor intensity: {region_stats.max_intensity:.3f}")
                         
                         st.write("Volume Statistics")
                         st.write(f"- Total volume: {total_volume:,.0f} voxels")
                         st.write(f"- Tumor volume: {tumor_volume:,.0f} voxels")
                         st.write(f"- Tumor percentage: {tumor_percentage:.2f}%")
                         
-                        if np.any(tumor_mask_bool):
-                            tumor_coords = np.where(tumor_mask_bool)
-                            tumor_size = [np.max(coord) - np.min(coord) for coord in tumor_coords]
+                        if region_stats.num_components:
                             st.write("\nTumor Dimensions (voxels):")
                             st.write(f"- X: {tumor_size[0]:.0f}")
                             st.write(f"- Y: {tumor_size[1]:.0f}")
                             st.write(f"- Z: {tumor_size[2]:.0f}")
                             
-                            tumor_center = [np.mean(coord) for coord in tumor_coords]
                             st.write("\nTumor Center (voxels):")
                             st.write(f"- X: {tumor_center[0]:.1f}")
                             st.write(f"- Y: {tumor_center[1]:.1f}")
                             st.write(f"- Z: {tumor_center[2]:.1f}")
+                        
+                        if threshold_tree is not None:
+                            st.write("\nTumor Volume vs. Sensitivity:")
+                            thresholds, volumes = threshold_tree.volume_curve(min_size)
+                            curve = go.Figure(go.Scatter(x=thresholds, y=volumes, mode='lines', name='Tumor volume'))
+                            curve.add_vline(x=threshold, line_dash='dash')
+                            curve.update_layout(
+                                xaxis_title="Detection Sensitivity",
+                                yaxis_title="Tumor volume (voxels)",
+                                height=300,
+                                margin=dict(l=0, r=0, t=20, b=0)
+                            )
+                            st.plotly_chart(curve, use_container_width=True)
                     except Exception as e:
                         st.error(f"Error calculating tumor statistics: {str(e)}")
                     
@@ -704,12 +2887,13 @@ if uploaded_file:
                 st.subheader("👨‍⚕️ AI Doctor Summary")
                 try:
                     if 'tumor_volume' in st.session_state:
-                        summary, error = safe_generate_ai_summary(
-                            st.session_state['tumor_volume'],
-                            st.session_state['tumor_percentage'],
-                            st.session_state['total_volume'],
-                            (1 - threshold) * 100
-                        )
+                        # Placeholder until the background request started after segmentation resolves
+                        pending = st.empty()
+                        if not summary_future.done():
+                            pending.info("⏳ Generating AI summary...")
+                        with profile_stage("summary_wait"):
+                            summary, error = summary_future.result()
+                        pending.empty()
                         if error:
                             st.error(error)
                         else:
@@ -725,5 +2909,15 @@ if uploaded_file:
                     st.error(f"Error in AI summary generation: {str(e)}")
         except Exception as e:
             st.error(f"Error processing MRI: {str(e)}")
+        finally:
+            # Runs ended by stop_run() are logged too
+            if PROFILE_LOG_PATH and profiler.records:
+                try:
+                    profiler.write_jsonl(PROFILE_LOG_PATH, source="app", scan=uploaded_file.name)
+                except OSError:
+                    # The log is for trend analysis only; an unwritable path must not break the page
+                    pass
+    
+    show_pipeline_profile(profile_placeholder, profiler)
 else:
     st.info("Please upload an MRI file to begin analysis.")
@@ -26,7 +26,7 @@ cd eliza_plugins\mri_3d_plugin
 if "%API_KEY%"=="" (
     python main.py --file_path "%FILE_PATH%" --threshold %THRESHOLD% --min_size %MIN_SIZE%
 ) else (
-    python main.py --file_path "%FILE_PATH%" --threshold %THRESHOLD% --min_size %MIN_SIZE% --gemini_api_key "%API_KEY%"
+    python main.py --file_path "%FILE_PATH%" --threshold %THRESHOLD% --min_size %MIN_SIZE% --summarize --gemini_api_key "%API_KEY%"
 )
 
 cd ..\..
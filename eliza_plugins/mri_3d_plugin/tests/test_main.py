@@ -0,0 +1,289 @@
+import os
+import sys
+import tracemalloc
+
+import nibabel as nib
+import numpy as np
+import pytest
+from scipy import ndimage
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import main
+
+
+def synthetic_volume(shape=(64, 72, 48), seed=0):
+    """Ellipsoid 'brain' inside a bright shell with a few mid-intensity blobs, plus noise"""
+    rng = np.random.default_rng(seed)
+    grid = np.indices(shape, dtype=np.float64)
+    center = (np.array(shape, dtype=np.float64) - 1)[:, None, None, None] / 2
+    radius = np.array(shape, dtype=np.float64)[:, None, None, None] / 2
+    r = np.sqrt((((grid - center) / radius) ** 2).sum(axis=0))
+    volume = np.where(r < 0.8, 0.3, 0.0) + np.where((r >= 0.8) & (r < 0.9), 1.0, 0.0)
+    for _ in range(6):
+        blob = rng.uniform(0.3, 0.7, 3) * np.array(shape)
+        inside = ((grid - blob[:, None, None, None]) ** 2).sum(axis=0) < rng.uniform(2, 4) ** 2
+        volume[inside] = rng.uniform(0.55, 0.75)
+    return volume + rng.normal(0, 0.03, shape)
+
+
+def reference_segment_tumor(volume, threshold, min_size):
+    """The original single-pass segmentation every optimized path must reproduce"""
+    volume_float = volume.astype(np.float64)
+    smoothed = ndimage.gaussian_filter(volume_float, sigma=1.0)
+    vmin, vmax = np.percentile(smoothed, (1, 99))
+    enhanced = np.clip((smoothed - vmin) / (vmax - vmin), 0, 1)
+    binary = enhanced > threshold
+    kernel = np.ones((3, 3, 3))
+    binary = ndimage.binary_opening(binary, structure=kernel)
+    binary = ndimage.binary_closing(binary, structure=kernel)
+    labeled, _ = ndimage.label(binary)
+    sizes = np.bincount(labeled.ravel())
+    mask_sizes = sizes > min_size
+    mask_sizes[0] = 0
+    for i in range(1, len(sizes)):
+        if mask_sizes[i]:
+            region = labeled == i
+            mean_intensity = np.mean(enhanced[region])
+            region_shape = np.sum(region, axis=(0, 1))
+            if (mean_intensity < 0.2 or mean_intensity > 0.8 or sizes[i] > volume_float.size * 0.3
+                    or np.max(region_shape) > volume_float.shape[2] * 0.8):
+                mask_sizes[i] = False
+    predicted_mask = mask_sizes[labeled]
+    predicted_mask = ndimage.binary_dilation(predicted_mask, iterations=1)
+    return ndimage.binary_erosion(predicted_mask, iterations=1)
+
+
+CASES = [(0, 0.5, 10), (1, 0.6, 10), (2, 0.4, 50)]
+
+
+@pytest.fixture(scope="module", params=CASES, ids=lambda case: "seed%d-t%s-min%d" % case)
+def case(request):
+    seed, threshold, min_size = request.param
+    volume = synthetic_volume(seed=seed)
+    expected = reference_segment_tumor(volume, threshold, min_size)
+    assert expected.any()
+    return volume, threshold, min_size, expected
+
+
+def assert_same_mask(mask, expected):
+    assert mask.shape == expected.shape
+    np.testing.assert_array_equal(np.asarray(mask).astype(bool), expected)
+
+
+@pytest.mark.parametrize("morphology", main.MORPHOLOGY_BACKENDS)
+def test_in_memory_segmentation_matches_reference(case, morphology):
+    volume, threshold, min_size, expected = case
+    mask, error = main.safe_segment_tumor(volume, threshold, min_size, morphology=morphology, workers=1)
+    assert error is None
+    assert_same_mask(mask, expected)
+
+
+@pytest.mark.parametrize("order", ["C", "F"])
+@pytest.mark.parametrize("slab_depth", [1, 5, 16])
+@pytest.mark.parametrize("morphology", main.MORPHOLOGY_BACKENDS)
+def test_slab_segmentation_matches_reference(case, slab_depth, order, morphology):
+    volume, threshold, min_size, expected = case
+    mask, error = main.safe_segment_tumor(np.asarray(volume, order=order), threshold, min_size,
+                                          slab_depth=slab_depth, morphology=morphology)
+    assert error is None
+    assert isinstance(mask, np.memmap)
+    assert_same_mask(mask, expected)
+
+
+@pytest.mark.skipif(not main._can_fork_workers(), reason="forking workers is unsafe here")
+@pytest.mark.parametrize("order", ["C", "F"])
+def test_parallel_segmentation_matches_reference(case, order):
+    volume, threshold, min_size, expected = case
+    mask = main._segment_tumor_parallel(np.asarray(volume, order=order), threshold, min_size, 2)
+    assert_same_mask(mask, expected)
+
+
+def test_staged_segmentation_matches_reference(case):
+    volume, threshold, min_size, expected = case
+    stages = main.SegmentationStages()
+    for _ in range(2):
+        mask, error = main.safe_segment_tumor(volume, threshold, min_size, stages=stages, volume_key="scan", workers=1)
+        assert error is None
+        assert_same_mask(mask, expected)
+
+
+def test_threshold_tree_matches_direct_segmentation(case):
+    volume, _, min_size, _ = case
+    stages = main.SegmentationStages()
+    tree, error = main.safe_threshold_tree(volume, stages=stages, volume_key="scan")
+    assert error is None
+    for threshold in (0.3, 0.45, 0.5, 0.6, 0.7):
+        mask, error = main.safe_segment_tumor(volume, threshold, min_size, stages=stages, volume_key="scan", workers=1)
+        assert error is None
+        assert_same_mask(mask, reference_segment_tumor(volume, threshold, min_size))
+        labeled, num_labels, _ = tree.components(threshold)
+        direct, direct_num, regions = main._label_components(main._enhance_volume(volume), threshold)
+        assert num_labels == direct_num
+        assert_same_partition(labeled, direct)
+        kept = regions["volume"][main._tumor_keep_flags(regions, min_size, volume.shape)].sum()
+        _, volumes = tree.volume_curve(min_size)
+        assert volumes[tree.level(threshold)] == kept
+
+
+def assert_same_partition(labels, expected):
+    """Same foreground and a one-to-one correspondence between the label ids"""
+    np.testing.assert_array_equal(labels > 0, expected > 0)
+    pairs = np.unique(np.stack([labels[expected > 0], expected[expected > 0]], axis=1), axis=0)
+    assert np.unique(pairs[:, 0]).size == pairs.shape[0] == np.unique(pairs[:, 1]).size
+
+
+@pytest.mark.parametrize("structure", ["box", "cross"])
+@pytest.mark.parametrize("backend", ["separable", "packed"])
+@pytest.mark.parametrize("shape", [(20, 17, 13), (9, 11, 16), (5, 6, 3)])
+def test_binary_morphology_matches_scipy(backend, structure, shape):
+    rng = np.random.default_rng(sum(shape))
+    mask = rng.random(shape) > 0.45
+    for operations in (("erode",), ("dilate",), ("erode", "dilate", "dilate", "erode"), ("dilate", "erode")):
+        expected = main.binary_morphology(mask, operations, structure=structure, backend="scipy")
+        result = main.binary_morphology(mask, operations, structure=structure, backend=backend)
+        np.testing.assert_array_equal(result, expected)
+
+
+@pytest.mark.parametrize("mask", [
+    np.zeros((6, 7, 8), dtype=bool),
+    np.ones((6, 7, 8), dtype=bool),
+    np.random.default_rng(0).random((30, 20, 10)) > 0.7,
+    np.pad(np.ones((3, 1, 2), dtype=bool), ((4, 5), (0, 6), (2, 1))),
+], ids=["empty", "full", "random", "box"])
+def test_compact_mask_round_trip(mask):
+    compact = main.CompactMask.from_mask(mask)
+    assert compact.tumor_volume == int(mask.sum())
+    np.testing.assert_array_equal(compact.to_mask(), mask)
+    restored = main.CompactMask.from_dict(compact.to_dict())
+    np.testing.assert_array_equal(restored.to_mask(), mask)
+    assert restored.tumor_volume == compact.tumor_volume
+    if not mask.any():
+        assert compact.bbox is None and restored.bbox is None
+
+
+@pytest.mark.parametrize("max_candidates", [main.STREAM_MAX_CANDIDATES, 64])
+@pytest.mark.parametrize("axis", [0, 2])
+def test_streaming_percentiles_match_numpy(axis, max_candidates):
+    rng = np.random.default_rng(axis)
+    data = np.concatenate([rng.normal(0, 1, 20000), np.full(3000, 0.25), rng.uniform(-5, 5, 1000)])
+    data = data.reshape(24, 25, 40)
+    percentiles = (0, 1, 37.5, 50, 99, 100)
+    result = main._streaming_percentiles(data, percentiles, axis, 3, (data.min(), data.max()), max_candidates=max_candidates)
+    np.testing.assert_array_equal(result, np.percentile(data, percentiles))
+
+
+@pytest.mark.parametrize("slab_depth", [1, 4, 7])
+@pytest.mark.parametrize("axis", [0, 2])
+def test_label_slabs_stitch_components_across_slabs(axis, slab_depth):
+    rng = np.random.default_rng(slab_depth)
+    binary = ndimage.binary_opening(rng.random((30, 26, 22)) > 0.35)
+    labeled = np.zeros(binary.shape, dtype=np.int32)
+    final, num_labels = main._label_slabs(binary, axis, slab_depth, labeled)
+    expected, expected_num = ndimage.label(binary)
+    assert num_labels == expected_num
+    assert_same_partition(final[labeled], expected)
+
+
+def test_merge_label_equivalences_joins_chains():
+    pairs = np.array([[1, 4], [4, 6], [2, 3], [5, 6]])
+    final = main._merge_label_equivalences(7, pairs)
+    assert final[0] == 0
+    assert final[1] == final[4] == final[5] == final[6]
+    assert final[2] == final[3] != final[1]
+    assert len({final[1], final[2], final[7]}) == 3
+
+
+def test_segmentation_stages_evict_within_budget():
+    volumes = {f"scan{seed}": synthetic_volume(seed=seed) for seed in range(3)}
+    one_scan = main.SegmentationStages()
+    one_scan.mask(volumes["scan0"], "scan0", 0.5, 10)
+    max_bytes = one_scan._nbytes + 1
+    stages = main.SegmentationStages(max_entries=2, max_bytes=max_bytes)
+    for key, volume in volumes.items():
+        assert_same_mask(stages.mask(volume, key, 0.5, 10), reference_segment_tumor(volume, 0.5, 10))
+        assert stages._nbytes <= max_bytes
+        assert stages._nbytes == sum(stages._sizes.values())
+        assert all(len(entries) <= 2 for entries in stages._stages.values())
+    assert all(stage_key[1][0] == "scan2" for stage_key in stages._sizes)
+    assert_same_mask(stages.mask(volumes["scan0"], "scan0", 0.5, 10), reference_segment_tumor(volumes["scan0"], 0.5, 10))
+    stages.clear()
+    assert stages._nbytes == 0 and not stages._sizes
+
+
+def test_out_of_core_load_and_segmentation_stay_under_memory_budget(tmp_path):
+    scan = np.round(synthetic_volume((128, 128, 96)) * 1000).astype(np.int16)
+    path = str(tmp_path / "scan.nii")
+    nib.save(nib.Nifti1Image(scan, np.eye(4)), path)
+    expected_volume, error = main.safe_load_normalized_volume(path, "native", memory_budget=None)
+    assert error is None
+    expected, error = main.safe_segment_tumor(expected_volume, 0.5, 10)
+    assert error is None and expected.any()
+    budget = expected_volume.nbytes // 4
+
+    tracemalloc.start()
+    try:
+        volume, error = main.safe_load_normalized_volume(path, "native", memory_budget=budget)
+        assert error is None
+        slab_depth = main.choose_segment_slab_depth(volume, budget)
+        mask, error = main.safe_segment_tumor(volume, 0.5, 10, slab_depth=slab_depth)
+        assert error is None
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+    assert isinstance(volume, np.memmap)
+    assert isinstance(mask, np.memmap)
+    assert slab_depth is not None
+    assert peak < budget
+    np.testing.assert_array_equal(volume, expected_volume)
+    np.testing.assert_array_equal(mask, expected)
+
+
+def test_batch_scan_stays_under_worker_memory_budget(tmp_path):
+    scan = np.round(synthetic_volume((128, 128, 96)) * 1000).astype(np.int16)
+    path = str(tmp_path / "scan.nii")
+    nib.save(nib.Nifti1Image(scan, np.eye(4)), path)
+    budget = scan.size * main.SEGMENT_BYTES_PER_VOXEL // 8
+    expected = main._analyze_scan(path, str(tmp_path / "expected_mask.nii.gz"), 0.5, 10, "native", None, main.MORPHOLOGY_BACKEND, None)
+    assert expected["error"] is None
+
+    tracemalloc.start()
+    try:
+        row = main._analyze_scan(path, str(tmp_path / "mask.nii.gz"), 0.5, 10, "native", budget, main.MORPHOLOGY_BACKEND, None)
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+    assert row["error"] is None
+    assert peak < budget
+    assert row["tumor_volume"] == expected["tumor_volume"] > 0
+    mask = np.asarray(nib.load(row["mask_file"]).dataobj)
+    assert mask.dtype == np.uint8
+    np.testing.assert_array_equal(mask, np.asarray(nib.load(expected["mask_file"]).dataobj))
+
+
+def test_profiler_records_peaks_only_for_exclusive_runs():
+    profiler = main.PipelineProfiler(trace_memory=True)
+    with profiler.activate():
+        with main.profile_stage("outer"):
+            with main.profile_stage("inner"):
+                buffer = np.ones(1 << 20)
+            del buffer
+    outer, inner = profiler.records
+    assert inner.process_peak_bytes >= 8 << 20
+    assert outer.process_peak_bytes >= inner.process_peak_bytes
+    assert not tracemalloc.is_tracing()
+
+    first, second = main.PipelineProfiler(trace_memory=True), main.PipelineProfiler(trace_memory=True)
+    with first.activate():
+        with main.profile_stage("before"):
+            pass
+        with main.profile_stage("overlapped"):
+            with second.activate():
+                with main.profile_stage("concurrent"):
+                    pass
+        with main.profile_stage("after"):
+            pass
+    assert [record.process_peak_bytes is not None for record in first.records] == [True, False, True]
+    assert second.records[0].process_peak_bytes is None
+    assert not tracemalloc.is_tracing()